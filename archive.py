@@ -0,0 +1,41 @@
+import logging
+import os
+import time
+
+import crud
+from database import SessionLocal
+
+# Keeps the responses table to the check-ins that are still read. The scheduler
+# runs archive_responses() nightly: the responses of check-ins more than
+# ARCHIVE_AFTER_CHECK_INS behind their goal's current one, and all responses of
+# achieved goals, move to responses_archive in transactions of at most
+# ARCHIVE_BATCH_SIZE rows, with a pause of ARCHIVE_PAUSE_SECONDS in between.
+# /responses/{goal_id}?history=true reads both tables (crud.get_responses_with_questions).
+#   ARCHIVE_AFTER_CHECK_INS  check-ins per goal kept in responses
+#   ARCHIVE_BATCH_SIZE       responses moved per transaction
+#   ARCHIVE_PAUSE_SECONDS    pause between two transactions
+
+ARCHIVE_AFTER_CHECK_INS = int(os.getenv("ARCHIVE_AFTER_CHECK_INS", 3))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 500))
+ARCHIVE_PAUSE_SECONDS = float(os.getenv("ARCHIVE_PAUSE_SECONDS", 0.05))
+
+archive_log = logging.getLogger("archive")
+
+
+def archive_responses(session_factory=SessionLocal, keep_check_ins: int = ARCHIVE_AFTER_CHECK_INS,
+                      batch_size: int = ARCHIVE_BATCH_SIZE, pause_seconds: float = ARCHIVE_PAUSE_SECONDS):
+    moved = 0
+    while True:
+        db = session_factory()
+        try:
+            batch = crud.archive_responses(db, keep_check_ins, batch_size)
+            db.commit()
+        finally:
+            db.close()
+        moved += batch
+        if batch < batch_size:
+            break
+        if pause_seconds:
+            time.sleep(pause_seconds)
+    archive_log.info("archived %d responses", moved)
+    return moved
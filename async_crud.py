@@ -0,0 +1,43 @@
+from datetime import datetime
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+import models
+from crud import FEED_COLUMNS
+from pagination import paginate, page
+
+# Async versions of the crud.py queries on the hot request paths, for handlers
+# running on the event loop with an AsyncSession. They mirror their crud.py
+# counterparts; an AsyncSession cannot lazy load, so relationships the callers
+# read are loaded up front.
+
+
+async def get_user_by_username(db: AsyncSession, username: str):
+    result = await db.execute(select(models.User).where(models.User.username == username)
+                              .where(models.User.deleted_at.is_(None)))
+    return result.scalars().first()
+
+
+async def get_goal(db: AsyncSession, goal_id: int):
+    goal = await db.get(models.Goal, goal_id)
+    return goal if goal is not None and goal.deleted_at is None else None
+
+
+async def get_feed(db: AsyncSession, cursor: str | None = None, limit: int | None = 100):
+    result = await db.execute(
+        paginate(select(models.Post).where(models.Post.deleted_at.is_(None)).options(selectinload(models.Post.poster)),
+                 FEED_COLUMNS, cursor, limit, descending=True)
+    )
+    return page(result.scalars().all(), FEED_COLUMNS, limit)
+
+
+async def get_token_revocations_after(db: AsyncSession, revocation_id: int):
+    result = await db.execute(
+        select(models.TokenRevocation)
+        .where(models.TokenRevocation.id > revocation_id)
+        .where(models.TokenRevocation.expires_at > datetime.utcnow())
+        .order_by(models.TokenRevocation.id)
+    )
+    return result.scalars().all()
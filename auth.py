@@ -0,0 +1,100 @@
+import json
+
+from jose import JWTError, jwt
+
+from principal_cache import principal_cache
+
+# Authenticates every request once, before routing. The bearer token is decoded
+# (or found in the principal cache) here and the result is left in
+# request.state, where get_current_user picks it up:
+#   request.state.claims -> the verified token payload
+#   request.state.user   -> the cached UserSnapshot, only set on a cache hit
+# Requests without a valid token to a non-public path are rejected here with a
+# 401, before the body is read or a database session is opened.
+
+PUBLIC_PATHS = {
+    "/",
+    "/metrics",  # no user login, but its own X-Metrics-Token, see main.require_metrics_token
+    "/signup",
+    "/token",
+    "/token/refresh",
+    "/verify_email/",
+    "/reset_password",
+    "/verify_reset_password/",
+    "/docs",
+    "/docs/oauth2-redirect",
+    "/openapi.json",
+    "/redoc",
+}
+
+PUBLIC_PATH_PREFIXES = (
+    "/public_goals/",
+)
+
+
+def is_public_path(path: str):
+    return path in PUBLIC_PATHS or path.startswith(PUBLIC_PATH_PREFIXES)
+
+
+def bearer_token(scope):
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() == "bearer" and token:
+                return token
+            return None
+    return None
+
+
+def decode_auth_token(token: str, secret_key: str, algorithm: str):
+    """returns the payload of a valid access token, otherwise None"""
+    try:
+        payload = jwt.decode(token, secret_key, algorithms=[algorithm])
+    except JWTError:
+        return None
+    if payload.get("typ") != "auth" or payload.get("sub") is None:
+        return None
+    return payload
+
+
+class AuthMiddleware:
+    def __init__(self, app, secret_key: str, algorithm: str):
+        self.app = app
+        self.secret_key = secret_key
+        self.algorithm = algorithm
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or is_public_path(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        token = bearer_token(scope)
+        if token is None:
+            await self.reject(send, "Not authenticated")
+            return
+
+        state = scope.setdefault("state", {})
+        cached = principal_cache.get(token)
+        if cached is not None:
+            state["user"], state["claims"] = cached
+        else:
+            claims = decode_auth_token(token, self.secret_key, self.algorithm)
+            if claims is None:
+                await self.reject(send, "Could not validate credentials")
+                return
+            state["claims"] = claims
+        state["token"] = token
+        await self.app(scope, receive, send)
+
+    async def reject(self, send, detail: str):
+        body = json.dumps({"detail": detail}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 401,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("latin-1")),
+                (b"www-authenticate", b"Bearer"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
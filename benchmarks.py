@@ -0,0 +1,796 @@
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import requests
+import uvicorn
+from fastapi import Request
+from fastapi.testclient import TestClient
+from sqlalchemy import event, insert, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+import crud
+import main
+import models
+import schemas
+from auth import decode_auth_token
+from database import create_db_engine, create_async_db_engine
+from migrations import DROPPED_INDEXES
+from password_engine import PasswordEngine
+from principal_cache import principal_cache
+from purge import Purger, purge_unverified_users
+from ratelimit import limiter
+from write_queue import WriteCoordinator, WRITE_QUEUE_MAX_BATCH, WRITE_QUEUE_WINDOW_MS
+
+# Benchmarks for the MAP backend, run against a real uvicorn server and a
+# throwaway SQLite database so the numbers include the HTTP and threadpool
+# overhead the Procfile deployment sees.
+#
+#   python benchmarks.py login --concurrency 16 --logins 10
+#   python benchmarks.py auth --costs 4 10 12 --concurrency 1 8 --output bench_auth.json
+#   python benchmarks.py sqlite --readers 8 --writers 2 --seconds 5
+#   python benchmarks.py indexes --users 200
+#   python benchmarks.py transactions --questions 10
+#   python benchmarks.py deletes --responses 10000
+#   python benchmarks.py unverified --users 1000 10000
+#   python benchmarks.py writes --concurrency 1 8 64 --writes 50
+#
+# --output writes the results as JSON (with the parameters and the interpreter
+# they were taken on) so runs can be compared between releases.
+
+
+def percentile(samples: list[float], pct: float):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def summarize(samples: list[float]):
+    return {"count": len(samples),
+            "p50_ms": round(percentile(samples, 50) * 1000, 2),
+            "p99_ms": round(percentile(samples, 99) * 1000, 2),
+            "mean_ms": round(statistics.fmean(samples) * 1000, 2) if samples else 0.0}
+
+
+def check_statuses(what: str, statuses: dict):
+    """fails the run when any request got an error status: its latency is not that of the work benchmarked"""
+    errors = {code: count for code, count in statuses.items() if not 200 <= code < 300}
+    if errors:
+        raise RuntimeError("{what}: error responses {errors} (all: {statuses})".format(
+            what=what, errors=errors, statuses=statuses))
+
+
+def temporary_database(sqlite_profile: str = "performance"):
+    path = os.path.join(tempfile.mkdtemp(prefix="map_bench_"), "bench.db")
+    engine = create_db_engine("sqlite:///" + path, sqlite_profile=sqlite_profile)
+    main.Base2.metadata.create_all(bind=engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def use_database(session_factory):
+    def override_get_db(request: Request):
+        db = session_factory()
+        try:
+            yield main.enlist_session(request, db)
+        finally:
+            db.close()
+
+    async_session_factory = sessionmaker(create_async_db_engine(str(session_factory.kw["bind"].url)),
+                                         class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+    async def override_get_async_db(request: Request):
+        async with async_session_factory() as db:
+            yield main.enlist_session(request, db)
+
+    main.app.dependency_overrides[main.get_db] = override_get_db
+    main.app.dependency_overrides[main.get_async_db] = override_get_async_db
+    main.app.dependency_overrides[main.is_running_tests] = lambda: True
+    # the benchmarks sign up and log in far faster than the rate limits allow
+    limiter.limits = {scope: (None, None) for scope in limiter.limits}
+
+
+class BenchServer:
+    def __init__(self, app):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=self.port,
+                                                    log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{port}".format(port=self.port)
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+def login(base_url: str, username: str, password: str):
+    return requests.post(base_url + "/token",
+                         data={"username": username, "password": password})
+
+
+def bench_login(concurrency: int, logins: int, workers: int):
+    """concurrent /token logins while a reader polls /see_posts"""
+    use_database(temporary_database())
+    results = {}
+    # the users are signed up at this cost: an engine with another one would rehash on every login
+    cost = main.password_engine.target_cost()
+    engines = {"inline": PasswordEngine(workers=0, max_pending=concurrency, cost=cost),
+               "pool": PasswordEngine(workers=workers, cost=cost)}
+    with BenchServer(main.app) as server:
+        users = []
+        for i in range(concurrency):
+            user = {"username": "bench{i}".format(i=i), "password": "secret{i}".format(i=i),
+                    "email": "bench{i}@example.com".format(i=i)}
+            assert requests.post(server.url + "/signup", json=user).status_code == 200
+            users.append(user)
+        token = login(server.url, users[0]["username"], users[0]["password"]).json()["access_token"]
+
+        for name, engine in engines.items():
+            main.password_engine = engine
+            login_times, read_times, statuses, read_statuses = [], [], {}, {}
+            stop = threading.Event()
+            lock = threading.Lock()
+
+            def login_worker(user):
+                for _ in range(logins):
+                    start = time.perf_counter()
+                    res = login(server.url, user["username"], user["password"])
+                    with lock:
+                        if res.status_code == 200:
+                            login_times.append(time.perf_counter() - start)
+                        statuses[res.status_code] = statuses.get(res.status_code, 0) + 1
+
+            def read_worker():
+                while not stop.is_set():
+                    start = time.perf_counter()
+                    res = requests.get(server.url + "/see_posts",
+                                       headers={"Authorization": "Bearer " + token})
+                    if res.status_code == 200:
+                        read_times.append(time.perf_counter() - start)
+                    read_statuses[res.status_code] = read_statuses.get(res.status_code, 0) + 1
+
+            reader = threading.Thread(target=read_worker)
+            threads = [threading.Thread(target=login_worker, args=(user,)) for user in users]
+            started = time.perf_counter()
+            reader.start()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            stop.set()
+            reader.join()
+            engine.shutdown()
+            check_statuses("login ({name})".format(name=name), statuses)
+            check_statuses("see_posts ({name})".format(name=name), read_statuses)
+            results[name] = {"login": summarize(login_times),
+                             "see_posts": summarize(read_times),
+                             "statuses": statuses,
+                             "logins_per_second": round(len(login_times) / elapsed, 2)}
+    main.app.dependency_overrides.clear()
+    return results
+
+
+def timed(func, iterations: int):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def run_concurrently(concurrency: int, requests_per_thread: int, send):
+    """calls send(client, thread_index, request_index) from `concurrency` threads, each with its own TestClient
+
+    The percentiles are of the 2xx responses; any other status fails the run.
+    """
+    samples, statuses = [], {}
+    lock = threading.Lock()
+
+    def worker(thread_index):
+        # not used as a context manager: the shutdown event would stop the password engine's pool
+        client = TestClient(main.app)
+        for request_index in range(requests_per_thread):
+            start = time.perf_counter()
+            res = send(client, thread_index, request_index)
+            with lock:
+                if 200 <= res.status_code < 300:
+                    samples.append(time.perf_counter() - start)
+                statuses[res.status_code] = statuses.get(res.status_code, 0) + 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    check_statuses(send.__name__, statuses)
+    result = summarize(samples)
+    result["statuses"] = statuses
+    result["requests_per_second"] = round(len(samples) / elapsed, 2)
+    return result
+
+
+def bench_auth(costs: list[int], concurrency_levels: list[int], iterations: int, workers: int):
+    """token creation/decoding, authenticate_user and /signup + /token round trips per bcrypt cost"""
+    session_factory = temporary_database()
+    use_database(session_factory)
+    results = {}
+
+    # token handling does not depend on the bcrypt cost
+    claims = {"sub": "bench", "typ": "auth", "jti": "bench", "ver": 0}
+    token = main.create_access_token(claims, main.timedelta(minutes=main.ACCESS_TOKEN_EXPIRE_MINUTES))
+    results["create_access_token"] = summarize(timed(lambda: main.create_access_token(claims), iterations * 10))
+    results["decode_access_token"] = summarize(
+        timed(lambda: decode_auth_token(token, main.SECRET_KEY, main.ALGORITHM), iterations * 10))
+
+    original_engine = main.password_engine
+    results["costs"] = {}
+    for cost in costs:
+        engine = PasswordEngine(workers=workers, max_pending=max(concurrency_levels), cost=cost)
+        main.password_engine = engine
+        cost_results = {}
+
+        db = session_factory()
+        passhash, salt, _ = engine.hash_password("secret")
+        username = "bench_cost{cost}".format(cost=cost)
+        user = crud.create_user(db, schemas.UserCreate(email=username + "@example.com", username=username,
+                                                       pw_hash=passhash, pw_salt=salt, pw_cost=cost))
+        crud.change_verified_status(db=db, user_id=user.id, is_verified=True)
+        db.commit()
+        cost_results["authenticate_user"] = summarize(
+            timed(lambda: main.authenticate_user(db, username, "secret"), iterations))
+        db.close()
+
+        # an authenticated request, with the principal loaded from the database and from the cache
+        client = TestClient(main.app)
+        access_token = client.post("/token", data={"username": username, "password": "secret"}) \
+            .json()["access_token"]
+        headers = {"Authorization": "Bearer " + access_token}
+
+        def get_goals():
+            res = client.get("/goals", headers=headers)
+            check_statuses("/goals", {res.status_code: 1})
+
+        def cold_request():
+            principal_cache.clear()
+            get_goals()
+
+        cost_results["get_current_user"] = {
+            "cold": summarize(timed(cold_request, iterations)),
+            "cached": summarize(timed(get_goals, iterations)),
+        }
+
+        cost_results["concurrency"] = {}
+        for concurrency in concurrency_levels:
+            prefix = "c{cost}_{concurrency}_".format(cost=cost, concurrency=concurrency)
+
+            def signup(client, thread_index, request_index):
+                name = "{prefix}{t}_{r}".format(prefix=prefix, t=thread_index, r=request_index)
+                return client.post("/signup", json={"username": name, "password": "secret",
+                                                    "email": name + "@example.com"})
+
+            def login(client, thread_index, request_index):
+                name = "{prefix}{t}_{r}".format(prefix=prefix, t=thread_index, r=request_index)
+                return client.post("/token", data={"username": name, "password": "secret"})
+
+            cost_results["concurrency"][str(concurrency)] = {
+                "signup": run_concurrently(concurrency, iterations, signup),
+                "token": run_concurrently(concurrency, iterations, login),
+            }
+        engine.shutdown()
+        results["costs"][str(cost)] = cost_results
+
+    main.password_engine = original_engine
+    main.app.dependency_overrides.clear()
+    return results
+
+
+def bench_sqlite(readers: int, writers: int, seconds: float, profiles: list[str]):
+    """forum reads and post/comment writes from concurrent threads, per SQLite profile"""
+    results = {}
+    for profile in profiles:
+        session_factory = temporary_database(sqlite_profile=profile)
+        db = session_factory()
+        author = crud.create_user(db, schemas.UserCreate(email="bench@example.com", username="bench",
+                                                         pw_hash="x", pw_salt="x"))
+        author_id = author.id
+        for i in range(200):
+            crud.create_post(db, title="post {i}".format(i=i), content="content", post_author=author_id)
+        db.commit()
+        db.close()
+
+        read_times, write_times, errors = [], [], {}
+        lock = threading.Lock()
+        stop = threading.Event()
+
+        def run(operation, samples):
+            db = session_factory()
+            while not stop.is_set():
+                start = time.perf_counter()
+                try:
+                    operation(db)
+                except Exception as e:
+                    db.rollback()
+                    with lock:
+                        errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                    continue
+                with lock:
+                    samples.append(time.perf_counter() - start)
+            db.close()
+
+        def read(db):
+            crud.get_feed(db)
+            db.rollback()  # end the read transaction like a request would
+
+        def write(db):
+            post = crud.create_post(db, title="new", content="content", post_author=author_id)
+            crud.create_comment(db, content="comment", post_id=post.post_id, comment_author=author_id)
+            db.commit()
+
+        threads = [threading.Thread(target=run, args=(read, read_times)) for _ in range(readers)]
+        threads += [threading.Thread(target=run, args=(write, write_times)) for _ in range(writers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        session_factory.kw["bind"].dispose()
+        results[profile] = {"read": summarize(read_times),
+                            "write": summarize(write_times),
+                            "reads_per_second": round(len(read_times) / seconds, 2),
+                            "writes_per_second": round(len(write_times) / seconds, 2),
+                            "errors": errors}
+    return results
+
+
+# indexes added around crud.py's filters, dropped again to rebuild the old layout
+COMPOSITE_INDEXES = ["ix_goals_creator_achieved", "ix_goals_creator_public", "ix_goals_can_check_in",
+                     "ix_goals_paused_next_check_in", "ix_responses_goal_check_in",
+                     "ix_questions_template_check_in", "ix_friends_user2_pending", "ix_comments_post_timestamp",
+                     "ix_templates_custom", "ix_posts_recent_comment", "ix_users_unverified"]
+
+
+def use_legacy_indexes(engine):
+    with engine.begin() as connection:
+        for name in COMPOSITE_INDEXES:
+            connection.execute(text('DROP INDEX "{name}"'.format(name=name)))
+        for name, (table, column) in DROPPED_INDEXES.items():
+            connection.execute(text('CREATE INDEX "{name}" ON {table} ({column})'
+                                    .format(name=name, table=table, column=column)))
+
+
+def seed_index_data(engine, users: int):
+    """users with goals, responses, friendships, posts and comments, inserted in bulk"""
+    long_text = "lorem ipsum dolor sit amet " * 20
+    goals_per_user, questions_per_template, comments_per_post = 10, 5, 5
+    with engine.begin() as connection:
+        connection.execute(insert(models.User.__table__), [
+            {"id": u, "username": "user{u}".format(u=u), "email": "user{u}@example.com".format(u=u),
+             "pw_hash": "x", "pw_salt": "x", "is_verified": True} for u in range(1, users + 1)])
+        connection.execute(insert(models.Template.__table__), [
+            {"template_id": u, "name": "template", "is_custom": True, "creator_id": u} for u in range(1, users + 1)])
+        connection.execute(insert(models.Question.__table__), [
+            {"template_id": u, "text": long_text, "check_in_num": q % 3 - 1}
+            for u in range(1, users + 1) for q in range(questions_per_template)])
+        goals = [{"id": (u - 1) * goals_per_user + g + 1, "creator_id": u, "template_id": u, "goal_name": "goal",
+                  "is_achieved": g % 4 == 0, "is_public": g % 3 == 0, "is_paused": g % 5 == 0,
+                  "can_check_in": g % 5 != 0 and g < 5, "next_check_in": main.date.today() + main.timedelta(days=g - 5),
+                  "check_in_num": 1}
+                 for u in range(1, users + 1) for g in range(goals_per_user)]
+        connection.execute(insert(models.Goal.__table__), goals)
+        connection.execute(insert(models.Response.__table__), [
+            {"goal_id": goal["id"], "question_id": 1, "text": long_text, "check_in_number": n}
+            for goal in goals for n in range(questions_per_template)])
+        connection.execute(insert(models.Friends.__table__), [
+            {"user1": u, "user2": (u + k) % users + 1, "pending": k == 1}
+            for u in range(1, users + 1) for k in range(1, 4)])
+        connection.execute(insert(models.Post.__table__), [
+            {"post_id": u, "title": "title", "content": long_text, "post_author": u,
+             "timestamp": main.datetime.now(), "recent_comment_timestamp": main.datetime.now()}
+            for u in range(1, users + 1)])
+        connection.execute(insert(models.Comment.__table__), [
+            {"post_id": u, "content": long_text, "comment_author": u, "timestamp": main.datetime.now()}
+            for u in range(1, users + 1) for _ in range(comments_per_post)])
+        connection.execute(text("ANALYZE"))
+
+
+def bench_indexes(users: int, iterations: int, inserts: int):
+    """crud.py inserts and filtered reads with the old and the current index layout"""
+    long_text = "lorem ipsum dolor sit amet " * 20
+    results = {}
+    for layout in ("legacy", "current"):
+        session_factory = temporary_database()
+        engine = session_factory.kw["bind"]
+        if layout == "legacy":
+            use_legacy_indexes(engine)
+        seed_index_data(engine, users)
+        db = session_factory()
+        user_ids = list(range(1, users + 1))
+
+        def cycle(func):
+            # a different user per call, so no query is answered from a warm page set
+            calls = iter(user_ids * (iterations // len(user_ids) + 1))
+            return summarize(timed(lambda: func(next(calls)), iterations))
+
+        def daily_check_in_update():
+            samples = []
+            for _ in range(iterations):
+                # the goals due today have not been flagged yet, as before the daily job
+                db.query(models.Goal).filter(models.Goal.next_check_in == main.date.today()) \
+                    .update({"can_check_in": False}, synchronize_session=False)
+                db.commit()
+                start = time.perf_counter()
+                crud.update_can_check_in(db)
+                db.commit()
+                samples.append(time.perf_counter() - start)
+            return summarize(samples)
+
+        reads = {
+            "get_achieved_goals": cycle(lambda u: crud.get_achieved_goals(u, db)),
+            "get_public_goals": cycle(lambda u: crud.get_public_goals(db, u)),
+            "get_checkin_goals": summarize(timed(lambda: crud.get_checkin_goals(db), iterations)),
+            "update_can_check_in": daily_check_in_update(),
+            "get_responses_by_goal": cycle(lambda u: crud.get_responses_by_goal(db, u * 10)),
+            "get_check_in_questions": cycle(lambda u: crud.get_check_in_questions(db, 1, u)),
+            "get_friend_requests": cycle(lambda u: crud.get_friend_requests(db, u)),
+            "get_comments_by_post": cycle(lambda u: crud.get_comments_by_post(db, u)),
+        }
+        db.expunge_all()
+
+        def committed(func):
+            # each insert in a transaction of its own, as a request making one would
+            def run():
+                func()
+                db.commit()
+            return run
+
+        writes = {
+            "create_response": summarize(timed(committed(lambda: crud.create_response(
+                db, text=long_text, question_id=1, check_in_number=9, goal_id=1)), inserts)),
+            "create_post": summarize(timed(committed(lambda: crud.create_post(
+                db, title="title", content=long_text, post_author=1)), inserts)),
+            "create_comment": summarize(timed(committed(lambda: crud.create_comment(
+                db, content=long_text, post_id=1, comment_author=1)), inserts)),
+        }
+        db.close()
+        engine.dispose()
+        results[layout] = {"reads": reads, "writes": writes}
+
+    # how many times faster the current layout is, per operation (mean latency)
+    results["speedup"] = {
+        name: round(results["legacy"][kind][name]["mean_ms"] / results["current"][kind][name]["mean_ms"], 2)
+        for kind in ("reads", "writes") for name in results["current"][kind]
+        if results["current"][kind][name]["mean_ms"]}
+    return results
+
+
+def bench_transactions(questions: int, iterations: int, sqlite_profile: str):
+    """write-heavy requests through the API, with the commits each one costs"""
+    session_factory = temporary_database(sqlite_profile=sqlite_profile)
+    engine = session_factory.kw["bind"]
+    use_database(session_factory)
+    client = TestClient(main.app)
+    # one letter usernames are verified on signup
+    for name in ("a", "b"):
+        client.post("/signup", json={"username": name, "password": "secret", "email": name + "@example.com"})
+    tokens = {name: client.post("/token", data={"username": name, "password": "secret"}).json()["access_token"]
+              for name in ("a", "b")}
+    headers = {"Authorization": "Bearer " + tokens["a"]}
+    commits = []
+    event.listen(engine, "commit", lambda connection: commits.append(1))
+
+    def measure(request):
+        del commits[:]
+        samples = timed(request, iterations)
+        return dict(summarize(samples), commits_per_request=round(len(commits) / iterations, 2))
+
+    goal = {"goal_name": "bench", "check_in_period": 7, "is_group": False,
+            "questions_answers": [["question {i}".format(i=i), "answer"] for i in range(questions)]}
+    group = dict(goal, group_name="bench", invites=["b"])
+    results = {
+        "create_custom_goal": measure(lambda: client.post("/create_custom_goal", json=goal, headers=headers)),
+        "create_custom_goal_and_group": measure(
+            lambda: client.post("/create_custom_goal_and_group", json=group, headers=headers)),
+    }
+    main.app.dependency_overrides.clear()
+    engine.dispose()
+    return results
+
+
+def seed_active_users(engine, users: int, responses: int):
+    """users with goals holding responses between them, a group each, posts, comments and friends"""
+    goals_per_user, questions_per_template = 10, 5
+    with engine.begin() as connection:
+        # the last user is everyone's friend, fellow group member and commenter
+        connection.execute(insert(models.User.__table__), [
+            {"id": u, "username": "user{u}".format(u=u), "email": "user{u}@example.com".format(u=u),
+             "pw_hash": "x", "pw_salt": "x", "is_verified": True} for u in range(1, users + 2)])
+        connection.execute(insert(models.Template.__table__), [
+            {"template_id": u, "name": "template", "is_custom": True, "creator_id": u} for u in range(1, users + 1)])
+        connection.execute(insert(models.Question.__table__), [
+            {"question_id": (u - 1) * questions_per_template + q + 1, "template_id": u, "text": "question"}
+            for u in range(1, users + 1) for q in range(questions_per_template)])
+        goals = [{"id": (u - 1) * goals_per_user + g + 1, "creator_id": u, "template_id": u, "goal_name": "goal"}
+                 for u in range(1, users + 1) for g in range(goals_per_user)]
+        connection.execute(insert(models.Goal.__table__), goals)
+        connection.execute(insert(models.Response.__table__), [
+            {"goal_id": (u - 1) * goals_per_user + n % goals_per_user + 1,
+             "question_id": (u - 1) * questions_per_template + n % questions_per_template + 1,
+             "text": "answer", "check_in_number": n // goals_per_user}
+            for u in range(1, users + 1) for n in range(responses)])
+        connection.execute(insert(models.Group.__table__), [
+            {"group_id": u, "creator_id": u, "group_name": "group", "template_id": u} for u in range(1, users + 1)])
+        connection.execute(insert(models.GroupMembers.__table__), [
+            {"group_id": u, "user_id": member, "pending": False}
+            for u in range(1, users + 1) for member in (u, users + 1)])
+        connection.execute(insert(models.Friends.__table__), [
+            {"user1": u, "user2": users + 1, "pending": False} for u in range(1, users + 1)])
+        connection.execute(insert(models.Post.__table__), [
+            {"post_id": (u - 1) * 10 + p + 1, "title": "title", "content": "content", "post_author": u,
+             "timestamp": main.datetime.now(), "recent_comment_timestamp": main.datetime.now()}
+            for u in range(1, users + 1) for p in range(10)])
+        connection.execute(insert(models.Comment.__table__), [
+            {"post_id": post_id, "content": "comment", "comment_author": author, "timestamp": main.datetime.now()}
+            for post_id in range(1, users * 10 + 1) for author in ((post_id - 1) // 10 + 1, users + 1)])
+
+
+def bench_deletes(responses: int, iterations: int, batch_size: int):
+    """deleting users with `responses` responses each: crud.delete_user, and what
+    /delete_account does now (soft_delete_user) with the purge that follows"""
+    session_factory = temporary_database()
+    engine = session_factory.kw["bind"]
+    seed_active_users(engine, iterations * 2, responses)
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(1))
+    db = session_factory()
+    user_ids = iter(range(1, iterations * 2 + 1))
+
+    def measure(delete):
+        del statements[:]
+
+        def run():
+            delete(db, next(user_ids))
+            db.commit()
+        samples = timed(run, iterations)
+        return dict(summarize(samples), statements_per_user=round(len(statements) / iterations, 2))
+
+    results = {"delete_user": measure(crud.delete_user), "soft_delete_user": measure(crud.soft_delete_user)}
+    db.close()
+    # the longest a request waits for the write lock is about one batch
+    batches = []
+    purger = Purger(session_factory, batch_size=batch_size, pause_seconds=0)
+    run_batch = purger.run_batch
+
+    def timed_batch(db, job):
+        start = time.perf_counter()
+        finished = run_batch(db, job)
+        db.commit()
+        batches.append(time.perf_counter() - start)
+        return finished
+    purger.run_batch = timed_batch
+    start = time.perf_counter()
+    purger.run_pending()
+    results["purge"] = {"seconds": round(time.perf_counter() - start, 2), "batches": summarize(batches)}
+    with engine.connect() as connection:
+        results["rows_left"] = {table: connection.execute(text("SELECT count(*) FROM " + table)).scalar()
+                                for table in ("responses", "goals", "comments", "posts", "groups")}
+    engine.dispose()
+    return results
+
+
+def bench_unverified(backlogs: list[int], batch_size: int):
+    """purge.purge_unverified_users on backlogs of expired unverified users, with its peak memory"""
+    results = {}
+    for users in backlogs:
+        session_factory = temporary_database()
+        engine = session_factory.kw["bind"]
+        sent = main.date.today() - main.timedelta(days=30)
+        with engine.begin() as connection:
+            connection.execute(insert(models.User.__table__), [
+                {"username": "user{u}".format(u=u), "email": "user{u}@example.com".format(u=u), "pw_hash": "x",
+                 "pw_salt": "x", "is_verified": False, "verification_sent_date": sent} for u in range(users)])
+        tracemalloc.start()
+        start = time.perf_counter()
+        deleted = purge_unverified_users(session_factory, batch_size=batch_size, pause_seconds=0)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        engine.dispose()
+        results[users] = {"deleted": deleted, "seconds": round(seconds, 3), "peak_kib": round(peak / 1024)}
+    return results
+
+
+def bench_writes(concurrency_levels: list[int], writes: int, profiles: list[str], window_ms: float,
+                 max_batch: int):
+    """comments and check-ins from concurrent writers, each committing vs the write queue's group commit"""
+    results = {}
+    for profile in profiles:
+        for concurrency in concurrency_levels:
+            for mode in ("direct", "queue"):
+                session_factory = temporary_database(sqlite_profile=profile)
+                engine = session_factory.kw["bind"]
+                db = session_factory()
+                author = crud.create_user(db, schemas.UserCreate(email="bench@example.com", username="bench",
+                                                                 pw_hash="x", pw_salt="x"))
+                template = crud.create_template(db, name="bench", is_custom=True, creator_id=author.id)
+                question = crud.create_question(db, text="question", template_id=template.template_id,
+                                                response_type=models.response_types(0), next_check_in_period=0)
+                post_id, question_id, author_id = \
+                    crud.create_post(db, title="post", content="content", post_author=author.id).post_id, \
+                    question.question_id, author.id
+                goal_ids = [crud.create_goal(db, goal_name="goal", check_in_period=7,
+                                             template_id=template.template_id, user_id=author_id,
+                                             is_group=False).id for _ in range(concurrency)]
+                db.commit()
+                db.close()
+
+                def comment(db):
+                    return crud.create_comment(db, content="comment", post_id=post_id,
+                                               comment_author=author_id).comment_id
+
+                def check_in(goal_id):
+                    def record_check_in(db):
+                        for _ in range(2):
+                            crud.create_response(db, text="answer", question_id=question_id, check_in_number=1,
+                                                 goal_id=goal_id)
+                        crud.after_check_in_update(goal_id=goal_id, db=db)
+                    return record_check_in
+
+                coordinator = WriteCoordinator(session_factory, enabled=True, window_ms=window_ms,
+                                               max_batch=max_batch)
+
+                def direct(operation):
+                    db = session_factory()
+                    try:
+                        operation(db)
+                        db.commit()
+                    finally:
+                        db.close()
+
+                def queued(operation):
+                    coordinator.submit(operation).result()
+
+                write = direct if mode == "direct" else queued
+                samples, errors = [], {}
+                lock = threading.Lock()
+
+                def writer(index):
+                    for i in range(writes):
+                        operation = comment if i % 2 == 0 else check_in(goal_ids[index])
+                        start = time.perf_counter()
+                        try:
+                            write(operation)
+                        except Exception as e:
+                            with lock:
+                                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                            continue
+                        with lock:
+                            samples.append(time.perf_counter() - start)
+
+                commits = []
+                event.listen(engine, "commit", lambda connection: commits.append(1))
+                threads = [threading.Thread(target=writer, args=(i,)) for i in range(concurrency)]
+                started = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = time.perf_counter() - started
+                coordinator.stop()
+                engine.dispose()
+                results["{profile} x{concurrency} {mode}".format(profile=profile, concurrency=concurrency,
+                                                                  mode=mode)] = \
+                    dict(summarize(samples), writes_per_second=round(len(samples) / elapsed, 2),
+                         commits=len(commits), errors=errors)
+    return results
+
+def print_results(title: str, results: dict):
+    print(title)
+    for name, result in results.items():
+        print("  {name}: {result}".format(name=name, result=result))
+
+
+def write_results(path: str, benchmark: str, params: dict, results: dict):
+    report = {"benchmark": benchmark,
+              "created_at": main.datetime.utcnow().isoformat(timespec="seconds") + "Z",
+              "python": platform.python_version(),
+              "cpu_count": os.cpu_count(),
+              "params": params,
+              "results": results}
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MAP backend benchmarks")
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+    login_parser = sub.add_parser("login", help="login latency under concurrent load")
+    login_parser.add_argument("--concurrency", type=int, default=16)
+    login_parser.add_argument("--logins", type=int, default=5)
+    login_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    login_parser.add_argument("--output", help="write the results to this JSON file")
+    auth_parser = sub.add_parser("auth", help="token handling, authenticate_user, /signup and /token")
+    auth_parser.add_argument("--costs", type=int, nargs="+", default=[4, 10, 12])
+    auth_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    auth_parser.add_argument("--iterations", type=int, default=10)
+    auth_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    auth_parser.add_argument("--output", help="write the results to this JSON file")
+    sqlite_parser = sub.add_parser("sqlite", help="concurrent reads and writes per SQLite pragma profile")
+    sqlite_parser.add_argument("--readers", type=int, default=8)
+    sqlite_parser.add_argument("--writers", type=int, default=2)
+    sqlite_parser.add_argument("--seconds", type=float, default=5)
+    sqlite_parser.add_argument("--profiles", nargs="+", default=["default", "performance"])
+    sqlite_parser.add_argument("--output", help="write the results to this JSON file")
+    indexes_parser = sub.add_parser("indexes", help="crud.py reads and inserts, old vs current indexes")
+    indexes_parser.add_argument("--users", type=int, default=200)
+    indexes_parser.add_argument("--iterations", type=int, default=200)
+    indexes_parser.add_argument("--inserts", type=int, default=200)
+    indexes_parser.add_argument("--output", help="write the results to this JSON file")
+    transactions_parser = sub.add_parser("transactions", help="write-heavy requests and their commits")
+    transactions_parser.add_argument("--questions", type=int, default=10)
+    transactions_parser.add_argument("--iterations", type=int, default=100)
+    transactions_parser.add_argument("--profile", default="performance", choices=["default", "performance"])
+    transactions_parser.add_argument("--output", help="write the results to this JSON file")
+    deletes_parser = sub.add_parser("deletes", help="deleting users with many rows")
+    deletes_parser.add_argument("--responses", type=int, default=10000)
+    deletes_parser.add_argument("--iterations", type=int, default=5)
+    deletes_parser.add_argument("--batch-size", type=int, default=500)
+    deletes_parser.add_argument("--output", help="write the results to this JSON file")
+    unverified_parser = sub.add_parser("unverified", help="deleting a backlog of unverified users")
+    unverified_parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000])
+    unverified_parser.add_argument("--batch-size", type=int, default=500)
+    unverified_parser.add_argument("--output", help="write the results to this JSON file")
+    writes_parser = sub.add_parser("writes", help="concurrent writers committing vs the write queue")
+    writes_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 64])
+    writes_parser.add_argument("--writes", type=int, default=50, help="writes per writer")
+    writes_parser.add_argument("--profiles", nargs="+", default=["performance", "default"])
+    writes_parser.add_argument("--window-ms", type=float, default=WRITE_QUEUE_WINDOW_MS)
+    writes_parser.add_argument("--max-batch", type=int, default=WRITE_QUEUE_MAX_BATCH)
+    writes_parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    params = {key: value for key, value in vars(args).items() if key not in ("benchmark", "output")}
+    if args.benchmark == "login":
+        results = bench_login(args.concurrency, args.logins, args.workers)
+    elif args.benchmark == "auth":
+        results = bench_auth(args.costs, args.concurrency, args.iterations, args.workers)
+    elif args.benchmark == "sqlite":
+        results = bench_sqlite(args.readers, args.writers, args.seconds, args.profiles)
+    elif args.benchmark == "indexes":
+        results = bench_indexes(args.users, args.iterations, args.inserts)
+    elif args.benchmark == "transactions":
+        results = bench_transactions(args.questions, args.iterations, args.profile)
+    elif args.benchmark == "deletes":
+        results = bench_deletes(args.responses, args.iterations, args.batch_size)
+    elif args.benchmark == "unverified":
+        results = bench_unverified(args.users, args.batch_size)
+    elif args.benchmark == "writes":
+        results = bench_writes(args.concurrency, args.writes, args.profiles, args.window_ms, args.max_batch)
+    print_results(args.benchmark, results)
+    if args.output:
+        write_results(args.output, args.benchmark, params, results)
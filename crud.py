@@ -1,11 +1,31 @@
 import enum
 from sqlalchemy.orm import Session
-from sqlalchemy import or_, and_
+from sqlalchemy import or_, and_, func, select, exists, inspect, tuple_, insert, union_all, literal
+from sqlalchemy.exc import IntegrityError
 from datetime import date, timedelta, datetime
 import models, schemas
+from principal_cache import principal_cache
+from database import call_after_commit
+from pagination import paginate, page
 
 
 
+# Drops the user's cached principal now and again once the transaction commits,
+# in case another request cached the old row in between.
+def invalidate_principal(db: Session, user_id: int):
+    principal_cache.invalidate_user(user_id)
+    call_after_commit(db, lambda: principal_cache.invalidate_user(user_id))
+
+# the same for a chunk of users, with one callback for all of them
+def invalidate_principals(db: Session, user_ids: list[int]):
+    user_ids = tuple(user_ids)
+
+    def invalidate():
+        for user_id in user_ids:
+            principal_cache.invalidate_user(user_id)
+    invalidate()
+    call_after_commit(db, invalidate)
+
 ###############################################################################
 
                         ### (C)RUD CREATE METHODS ###
@@ -18,40 +38,36 @@ def create_question(db: Session, text: str, template_id: int, response_type: enu
                                   response_type=response_type,check_in_num=0,
                                   next_check_in_period=next_check_in_period)
     db.add(db_question)
-    db.commit()
-    db.refresh(db_question)
+    db.flush()
     return db_question
 
 def create_response(db: Session, text: str, question_id: int, check_in_number: int, goal_id: int):
     db_response = models.Response(question_id=question_id, goal_id=goal_id, text=text,
                                   check_in_number=check_in_number)
     db.add(db_response)
-    db.commit()
-    db.refresh(db_response)
+    db.flush()
     return db_response
 
 def create_post(db: Session, title: str, content: str, post_author: int):
     db_post = models.Post(title=title, content=content, post_author=post_author, timestamp=datetime.now(),
                           recent_comment_timestamp=datetime.now())
     db.add(db_post)
-    db.commit()
-    db.refresh(db_post)
+    db.flush()
     return db_post
 
 def create_comment(db: Session, content:str, post_id: int, comment_author: int):
     db_comment = models.Comment(content=content, timestamp=datetime.now(), post_id=post_id, comment_author=comment_author)
     db.add(db_comment)
-    db.commit()
-    db.refresh(db_comment)
+    db.flush()
     update_recent_timestamp(db, post_id, db_comment.timestamp)
     return db_comment
 
 def create_user(db: Session, user: schemas.UserCreate):
     db_user = models.User(email=user.email, username=user.username,
-                          pw_hash=user.pw_hash, pw_salt=user.pw_salt, verification_sent_date=date.today())
+                          pw_hash=user.pw_hash, pw_salt=user.pw_salt, pw_cost=user.pw_cost,
+                          verification_sent_date=date.today())
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    db.flush()
     return db_user
 
 def create_goal(db: Session, goal_name: str, check_in_period: int,
@@ -62,36 +78,57 @@ def create_goal(db: Session, goal_name: str, check_in_period: int,
                           next_check_in=date.today() + timedelta(days=check_in_period),
                           is_group_goal=is_group)
     db.add(db_goal)
-    db.commit()
-    db.refresh(db_goal)
+    db.flush()
     return db_goal
 
 def create_template(db: Session, name: str, is_custom: bool, creator_id: int):
     db_template = models.Template(name=name)
     if not is_custom:
         db_template.is_custom = False
-        db_template.creator_id = -1
+        # shared templates have no creator (a -1 would violate the users foreign key)
+        db_template.creator_id = None
     else:
         db_template.is_custom = True
         db_template.creator_id = creator_id
     db.add(db_template)
-    db.commit()
-    db.refresh(db_template)
+    db.flush()
     return db_template
 
 def create_friend_request(db: Session, user_id1: int, user_id2: int):
     db_friends = models.Friends(user1=user_id1, user2=user_id2)
     db.add(db_friends)
-    db.commit()
-    db.refresh(db_friends)
+    db.flush()
     return db_friends
 
+def create_refresh_token(db: Session, user_id: int, token_hash: str, expires_at: datetime):
+    db_token = models.RefreshToken(user_id=user_id, token_hash=token_hash, expires_at=expires_at)
+    db.add(db_token)
+    db.flush()
+    return db_token
+
+def create_token_revocation(db: Session, user_id: int, jti: str | None, token_version: int | None,
+                            expires_at: datetime):
+    db_revocation = models.TokenRevocation(user_id=user_id, jti=jti, token_version=token_version,
+                                           expires_at=expires_at)
+    db.add(db_revocation)
+    db.flush()
+    return db_revocation
+
+# returns False when the token was already redeemed (by this or another worker)
+def create_redeemed_token(db: Session, jti: str, expires_at: datetime):
+    # in a savepoint, so a replay only undoes this insert and not the request's other work
+    try:
+        with db.begin_nested():
+            db.add(models.RedeemedToken(jti=jti, expires_at=expires_at))
+    except IntegrityError:
+        return False
+    return True
+
 ###user_id is the creator of the group
 def create_group(db: Session, name: str, user_id: int, template_id: int):
     db_group = models.Group(creator_id=user_id, group_name=name, template_id=template_id)
     db.add(db_group)
-    db.commit()
-    db.refresh(db_group)
+    db.flush()
     
     ###creator of a group should automatically be a member, so create invite, then accept invite
     create_group_invite(db=db, group_id=db_group.group_id, user_id=user_id)
@@ -101,8 +138,7 @@ def create_group(db: Session, name: str, user_id: int, template_id: int):
 def create_group_invite(db: Session, group_id: int, user_id: int):
     db_groupMember = models.GroupMembers(group_id=group_id, user_id=user_id)
     db.add(db_groupMember)
-    db.commit()
-    db.refresh(db_groupMember)
+    db.flush()
     return db_groupMember
 ###############################################################################
 
@@ -112,89 +148,142 @@ def create_group_invite(db: Session, group_id: int, user_id: int):
 
 ### GET USERS
 
+# soft deleted users, posts and goals (see soft_delete_user) are left out by every getter
+def query_users(db: Session):
+    return db.query(models.User).filter(models.User.deleted_at.is_(None))
+
 def get_user(db: Session, user_id: int):
-    return db.query(models.User).filter(models.User.id == user_id).first()
+    return query_users(db).filter(models.User.id == user_id).first()
 
 def get_user_by_email(db: Session, email: str):
-    return db.query(models.User).filter(models.User.email == email).first()
+    return query_users(db).filter(models.User.email == email).first()
 
 def get_user_by_username(db: Session, username: str):
-    return db.query(models.User).filter(models.User.username == username).first()
+    return query_users(db).filter(models.User.username == username).first()
 
-def get_users(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.User).offset(skip).limit(limit).all()
+# The list getters below take a cursor and limit and return a pagination.Page;
+# without a limit they return every row, still in page order.
+
+def get_users(db: Session, cursor: str | None = None, limit: int | None = 100):
+    columns = [models.User.id]
+    return page(paginate(query_users(db), columns, cursor, limit).all(), columns, limit)
+
+# user id -> username for the given ids
+def get_usernames(db: Session, user_ids: list[int]):
+    if not user_ids:
+        return {}
+    return dict(db.query(models.User.id, models.User.username).filter(models.User.id.in_(user_ids)).all())
 
 def get_user_profile(db: Session, user_id: int):
-    return db.query(models.User.username, models.User.email, models.User.id) \
-    .filter(models.User.id==user_id).first()
+    return query_user_profiles(db).filter(models.User.id==user_id).first()
 
-def get_public_goals(db: Session, user_id: int):
-    return db.query(models.Goal) \
+def get_public_goals(db: Session, user_id: int, cursor: str | None = None, limit: int | None = None):
+    query = query_goals(db) \
         .filter(models.Goal.creator_id==user_id) \
-        .filter(models.Goal.is_public==True).all()
+        .filter(models.Goal.is_public==True)
+    return page(paginate(query, [models.Goal.id], cursor, limit).all(), [models.Goal.id], limit)
 
 def get_not_verified_users(db: Session):
-    return db.query(models.User).filter(models.User.is_verified == False).all()
+    return query_users(db).filter(models.User.is_verified == False).all()
+
+
+### GET REFRESH TOKENS
+
+def get_refresh_token(db: Session, token_hash: str):
+    return db.query(models.RefreshToken).filter(models.RefreshToken.token_hash == token_hash).first()
+
+### GET TOKEN REVOCATIONS
+
+def get_token_revocations_after(db: Session, revocation_id: int):
+    return db.query(models.TokenRevocation) \
+        .filter(models.TokenRevocation.id > revocation_id) \
+        .filter(models.TokenRevocation.expires_at > datetime.utcnow()) \
+        .order_by(models.TokenRevocation.id).all()
 
 
 ### GET GOALS
 
+def query_goals(db: Session):
+    return db.query(models.Goal).filter(models.Goal.deleted_at.is_(None))
+
+# by primary key through the identity map: free when the session already holds the goal
 def get_goal(db: Session, goal_id: int):
-    return db.query(models.Goal).filter(models.Goal.id == goal_id).first()
+    goal = db.get(models.Goal, goal_id)
+    return goal if goal is not None and goal.deleted_at is None else None
 
 def get_user_goals(user_id: int, db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Goal).filter(models.Goal.creator_id == user_id).all()
+    return query_goals(db).filter(models.Goal.creator_id == user_id).all()
 
 def get_user_goals_by_id(db: Session, user_id: int):
-    return db.query(models.Goal).filter(models.Goal.creator_id == user_id).all()
+    return query_goals(db).filter(models.Goal.creator_id == user_id).all()
 
 def get_checkin_goals(db: Session):
-    return db.query(models.Goal).filter(models.Goal.can_check_in == True).all()
+    return query_goals(db).filter(models.Goal.can_check_in == True).all()
 
-def get_achieved_goals(username: str, db: Session):
-    user=db.query(models.User).filter(models.User.username == username).first()
-    return db.query(models.Goal).filter(models.Goal.creator_id == user.id) \
-        .filter(models.Goal.is_achieved == True).all()
+def get_achieved_goals(user_id: int, db: Session, cursor: str | None = None, limit: int | None = None):
+    query = query_goals(db).filter(models.Goal.creator_id == user_id) \
+        .filter(models.Goal.is_achieved == True)
+    return page(paginate(query, [models.Goal.id], cursor, limit).all(), [models.Goal.id], limit)
 
-def get_unachieved_goals(username: str, db: Session):
-    user=db.query(models.User).filter(models.User.username == username).first()
-    return db.query(models.Goal).filter(models.Goal.creator_id == user.id) \
-        .filter(models.Goal.is_achieved == False).all()
+def get_unachieved_goals(user_id: int, db: Session, cursor: str | None = None, limit: int | None = None):
+    query = query_goals(db).filter(models.Goal.creator_id == user_id) \
+        .filter(models.Goal.is_achieved == False)
+    return page(paginate(query, [models.Goal.id], cursor, limit).all(), [models.Goal.id], limit)
 
 ### GET TEMPLATES
 
 def get_template(db: Session, template_id: int):
     return db.query(models.Template).filter(models.Template.template_id == template_id).first()
 
-def get_premade_templates(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Template).filter(models.Template.is_custom == False).offset(skip).limit(limit).all()
+def get_premade_templates(db: Session, cursor: str | None = None, limit: int | None = 100):
+    columns = [models.Template.template_id]
+    query = db.query(models.Template).filter(models.Template.is_custom == False)
+    return page(paginate(query, columns, cursor, limit).all(), columns, limit)
 
 ### GET COMMENTS
 
 def get_comments_by_post(db: Session, post_id: int):
     return db.query(models.Comment).filter(models.Comment.post_id == post_id).all()
 
+# (comment, author username) pairs, oldest first
+def get_comments_with_authors(db: Session, post_id: int, cursor: str | None = None, limit: int | None = None):
+    columns = [models.Comment.timestamp, models.Comment.comment_id]
+    query = db.query(models.Comment, models.User.username) \
+        .join(models.User, models.User.id == models.Comment.comment_author) \
+        .filter(models.User.deleted_at.is_(None)) \
+        .filter(models.Comment.post_id == post_id)
+    return page(paginate(query, columns, cursor, limit).all(), columns, limit,
+                key=lambda row: [row[0].timestamp, row[0].comment_id])
+
 def get_comments_by_author(db: Session, user_id: int):
-    return db.query(models.Comment).filter(models.Comment.comment_author == user_id).all()
+    return db.query(models.Comment).join(models.User, models.User.id == models.Comment.comment_author) \
+        .filter(models.User.deleted_at.is_(None)).filter(models.Comment.comment_author == user_id).all()
 
 def get_comment_by_id(db: Session, comment_id: int):
     return db.query(models.Comment).filter(models.Comment.comment_id == comment_id).first()
 
 ### GET POSTS
 
+def query_posts(db: Session):
+    return db.query(models.Post).filter(models.Post.deleted_at.is_(None))
+
 def get_posts_by_author(db: Session, post_author: int):
-    return db.query(models.Post).filter(models.Post.post_author == post_author).all()
+    return query_posts(db).filter(models.Post.post_author == post_author).all()
 
 def get_post_by_id(db: Session, post_id: int):
-    return db.query(models.Post).filter(models.Post.post_id == post_id).first()
+    post = db.get(models.Post, post_id)
+    return post if post is not None and post.deleted_at is None else None
 
 ### recent posts
 def get_posts_after_timestamp(db: Session, timestamp: datetime):
-    return db.query(models.Post).filter(models.Post.timestamp > timestamp).all()
+    return query_posts(db).filter(models.Post.timestamp > timestamp).all()
+
+# most recently commented first
+FEED_COLUMNS = [models.Post.recent_comment_timestamp, models.Post.post_id]
 
-def get_feed(db: Session, skip: int=0, limit: int=100):
-    return db.query(models.Post).order_by(models.Post.recent_comment_timestamp.desc()) \
-        .offset(skip).limit(limit).all()
+def get_feed(db: Session, cursor: str | None = None, limit: int | None = 100):
+    rows = paginate(query_posts(db), FEED_COLUMNS, cursor, limit, descending=True).all()
+    return page(rows, FEED_COLUMNS, limit)
 
 ### GET QUESTIONS
 
@@ -204,6 +293,12 @@ def get_questions_by_template(db: Session, template_id: int):
 def get_question(db: Session, question_id: int):
     return db.query(models.Question).filter(models.Question.question_id == question_id).first()
 
+def get_questions_by_templates(db: Session, template_ids: list[int]):
+    if not template_ids:
+        return []
+    return db.query(models.Question).filter(models.Question.template_id.in_(template_ids)) \
+        .order_by(models.Question.question_id).all()
+
 def get_check_in_questions(db: Session, this_check_in: int, this_template: int):
     return db.query(models.Question) \
         .filter(models.Question.template_id == this_template) \
@@ -214,6 +309,25 @@ def get_check_in_questions(db: Session, this_check_in: int, this_template: int):
 def get_responses_by_goal(db: Session, goal_id: int):
     return db.query(models.Response).filter(models.Response.goal_id == goal_id).all()
 
+def get_responses_by_check_in(db: Session, goal_id: int, check_in_number: int):
+    return db.query(models.Response).filter(models.Response.goal_id == goal_id) \
+        .filter(models.Response.check_in_number == check_in_number).all()
+
+# rows of text, check_in_number and question (the question's text), oldest first;
+# with history the archived responses are included (see archive.py)
+def get_responses_with_questions(db: Session, goal_id: int, history: bool = False):
+    def responses_of(model):
+        return select(model.response_id, model.question_id, model.text, model.check_in_number) \
+            .where(model.goal_id == goal_id)
+
+    responses = responses_of(models.Response)
+    if history:
+        responses = union_all(responses, responses_of(models.ArchivedResponse))
+    responses = responses.subquery()
+    return db.query(responses.c.text, responses.c.check_in_number, models.Question.text.label("question")) \
+        .join(models.Question, models.Question.question_id == responses.c.question_id) \
+        .order_by(responses.c.response_id).all()
+
 def get_responses_by_question(db: Session, question_id: int):
     return db.query(models.Response).filter(models.Response.question_id == question_id).all()
 
@@ -230,48 +344,43 @@ def get_friendship(db: Session, user_id1: int, user_id2: int):
 def accept_friend_request(db: Session, user_id1: int, user_id2: int):
     friendship = get_friendship(db=db, user_id1=user_id1, user_id2=user_id2)
     friendship.pending = False
-    db.commit()
-    db.refresh(friendship)
+    db.flush()
     return friendship
 
 def deny_friend_request(db: Session, user_id1: int, user_id2: int):
     friendship = get_friendship(db=db, user_id1=user_id1, user_id2=user_id2)
     db.delete(friendship)
-    db.commit()
+    db.flush()
     return "friendship ended"
 
-def get_users_friends(db: Session, user_id: int):
-    friends = []
-    for friend in db.query(models.Friends).filter(models.Friends.user1==user_id) \
-            .filter(models.Friends.pending == False).all():
-        friends.append(friend.user2)
-    for friend in db.query(models.Friends).filter(models.Friends.user2==user_id) \
-            .filter(models.Friends.pending == False).all():
-        friends.append(friend.user1)
-    for i in range(len(friends)):
-        friends[i] = get_user_profile(db=db, user_id=friends[i])
-    return friends
+# the profile columns of get_user_profile, for queries joining users to a list of ids
+def query_user_profiles(db: Session):
+    return db.query(models.User.username, models.User.email, models.User.id).filter(models.User.deleted_at.is_(None))
+
+def get_users_friends(db: Session, user_id: int, cursor: str | None = None, limit: int | None = None):
+    # one query per side of the friendship instead of one per friend, merged by friend id
+    rows = []
+    for me, friend in ((models.Friends.user1, models.Friends.user2), (models.Friends.user2, models.Friends.user1)):
+        query = query_user_profiles(db).join(models.Friends, friend == models.User.id) \
+            .filter(me == user_id).filter(models.Friends.pending == False)
+        rows += paginate(query, [friend], cursor, limit).all()
+    rows.sort(key=lambda row: row.id)
+    return page(rows, [models.User.id], limit, key=lambda row: [row.id])
 
 def get_friend_requests(db: Session, user_id: int):
-    friends = []
-    for friend in db.query(models.Friends).filter(models.Friends.user2==user_id) \
-            .filter(models.Friends.pending == True).all():
-        friends.append(friend.user1)
-    for i in range(len(friends)):
-        friends[i] = get_user_profile(db=db, user_id=friends[i])
-    return friends
+    return query_user_profiles(db).join(models.Friends, models.Friends.user1 == models.User.id) \
+        .filter(models.Friends.user2 == user_id).filter(models.Friends.pending == True).all()
 
 def accept_group_invite(db: Session, group_id: int, user_id: int):
     membership = get_membership(db=db, group_id=group_id, user_id=user_id)
     membership.pending = False
-    db.commit()
-    db.refresh(membership)
+    db.flush()
     return membership
 
 def deny_group_invite(db: Session, group_id: int, user_id: int):
     membership = get_membership(db=db, group_id=group_id, user_id=user_id)
     db.delete(membership)
-    db.commit()
+    db.flush()
     return "membership denied"
 
 def get_group(db: Session, group_id: int):
@@ -281,21 +390,14 @@ def get_membership(db: Session, group_id: int, user_id: int):
     return db.query(models.GroupMembers).filter(and_(models.GroupMembers.group_id==group_id, models.GroupMembers.user_id==user_id)).first()
 
 def get_group_members(db: Session, group_id: int):
-    members = []
-    for member in db.query(models.GroupMembers).filter(models.GroupMembers.group_id==group_id).filter(models.GroupMembers.pending == False).all():
-        members.append(member.user_id)
-    
-    for i in range(len(members)):
-        members[i] = get_user_profile(db=db, user_id=members[i])
-
-    return members    
+    return query_user_profiles(db).join(models.GroupMembers, models.GroupMembers.user_id == models.User.id) \
+        .filter(models.GroupMembers.group_id == group_id).filter(models.GroupMembers.pending == False).all()
 
 def update_group_owner(db: Session, group_id: int, user_id: int):
     group = get_group(db, group_id)
     if group:
         group.creator_id = user_id
-        db.commit()
-        db.refresh(group)
+        db.flush()
         return True
     else:
         return False
@@ -308,21 +410,23 @@ def get_user_groups(db: Session, user_id: int):
     return db.query(models.GroupMembers).filter(models.GroupMembers.user_id==user_id).all()
 
 def get_group_invites(db: Session, user_id: int):
-    groups = []
-    for group in db.query(models.GroupMembers).filter(models.GroupMembers.user_id==user_id).filter(models.GroupMembers.pending == True).all():
-        groups.append(get_group(db=db, group_id=group.group_id)) 
-    return groups
+    # a deleted user keeps the groups nobody joined until the purge, not their invites
+    return db.query(models.Group).join(models.GroupMembers, models.GroupMembers.group_id == models.Group.group_id) \
+        .join(models.User, models.User.id == models.Group.creator_id).filter(models.User.deleted_at.is_(None)) \
+        .filter(models.GroupMembers.user_id == user_id).filter(models.GroupMembers.pending == True).all()
 
 def get_user_groups(db: Session, user_id: int):
-    groups = []
-    for group in db.query(models.GroupMembers).filter(models.GroupMembers.user_id==user_id).filter(models.GroupMembers.pending == False).all():
-        groups.append(get_group(db=db, group_id=group.group_id)) 
-    return groups
+    return db.query(models.Group).join(models.GroupMembers, models.GroupMembers.group_id == models.Group.group_id) \
+        .filter(models.GroupMembers.user_id == user_id).filter(models.GroupMembers.pending == False).all()
 def get_template_by_creator(db: Session, creator_id: int):
     return db.query(models.Template).filter(models.Template.creator_id == creator_id).all()
 
+def template_in_use(db: Session, template_id: int):
+    return db.query(models.Goal.id).filter(models.Goal.template_id == template_id).first() is not None \
+        or db.query(models.Group.group_id).filter(models.Group.template_id == template_id).first() is not None
+
 def get_goal_by_group(db: Session, group_id: int):
-    return db.query(models.Goal).filter(models.Goal.group_id == group_id)
+    return query_goals(db).filter(models.Goal.group_id == group_id)
 
 
 ###############################################################################
@@ -334,8 +438,7 @@ def update_user_verification(db: Session, user_id: int):
     user = get_user(db, user_id)
     if user:
         user.is_verified = True
-        db.commit()
-        db.refresh(user)
+        db.flush()
         return True
     return False
 
@@ -343,8 +446,7 @@ def update_recent_timestamp (db: Session, post_id: int, timestamp: datetime):
     post = get_post_by_id(db, post_id)
     if post:
         post.recent_comment_timestamp = timestamp
-        db.commit()
-        db.refresh(post)
+        db.flush()
         return True ###post found, most recent comment timestamp updated
     return False ###post not found, most recent comment timestamp not updated
 
@@ -352,8 +454,7 @@ def edit_comment(db: Session, comment_id, newcontent: str):
     comment = get_comment_by_id(db, comment_id)
     if comment:
         comment.content = newcontent
-        db.commit()
-        db.refresh(comment)
+        db.flush()
         return True
     return False
 
@@ -361,8 +462,7 @@ def edit_post_title(db: Session, post_id, newtitle: str):
     post = get_post_by_id(db, post_id)
     if post:
         post.title = newtitle
-        db.commit()
-        db.refresh(post)
+        db.flush()
         return True
     return False
 
@@ -371,8 +471,7 @@ def edit_post_content(db: Session, post_id, newcontent: str):
     if post:
         post.content = newcontent
         post.recent_comment_timestamp = datetime.now()
-        db.commit()
-        db.refresh(post)
+        db.flush()
         return True
     return False
 
@@ -381,8 +480,7 @@ def update_goal_check_in_period(db: Session, goal_id: int, new_check_in: int):
     if goal:    
         goal.check_in_period = new_check_in
         goal.next_check_in = goal.start_date + timedelta(days=goal.check_in_period)
-        db.commit()
-        db.refresh(goal)
+        db.flush()
         return True
     return False
 
@@ -390,31 +488,55 @@ def mark_goal_achieved(db: Session, goal_id: int):
     goal = get_goal(db, goal_id)
     if goal:
         goal.is_achieved = True
-        db.commit()
-        db.refresh(goal)
+        db.flush()
         return True
     return False
 
 def update_can_check_in(db: Session):
+    # only touch goals whose flag changes; both are range scans on (is_paused, next_check_in)
+    today = date.today()
+    db.query(models.Goal).filter(models.Goal.is_paused == False) \
+        .filter(models.Goal.next_check_in <= today).filter(models.Goal.can_check_in == False) \
+        .update({'can_check_in': True}, synchronize_session=False)
     db.query(models.Goal).filter(models.Goal.is_paused == False) \
-        .update({'can_check_in': models.Goal.next_check_in <= date.today()})
-    db.commit()
+        .filter(models.Goal.next_check_in > today).filter(models.Goal.can_check_in == True) \
+        .update({'can_check_in': False}, synchronize_session=False)
+    db.flush()
     return "goals updated"
 
+# Moves up to limit responses of check-ins more than keep_check_ins behind their
+# goal, or of achieved goals, to responses_archive; returns how many were moved.
+def archive_responses(db: Session, keep_check_ins: int, limit: int):
+    response_ids = [row.response_id for row in db.query(models.Response.response_id)
+                    .join(models.Goal, models.Goal.id == models.Response.goal_id)
+                    .filter(models.Goal.deleted_at.is_(None))
+                    .filter(or_(models.Goal.is_achieved == True,
+                                models.Response.check_in_number <= models.Goal.check_in_num - keep_check_ins))
+                    .order_by(models.Response.response_id).limit(limit)]
+    if not response_ids:
+        return 0
+    columns = ["response_id", "question_id", "goal_id", "text", "check_in_number"]
+    db.execute(insert(models.ArchivedResponse).from_select(
+        columns + ["archived_at"],
+        select(*[getattr(models.Response, column) for column in columns], literal(datetime.utcnow()))
+        .where(models.Response.response_id.in_(response_ids))))
+    db.query(models.Response).filter(models.Response.response_id.in_(response_ids)) \
+        .delete(synchronize_session=False)
+    db.flush()
+    return len(response_ids)
+
 def toggle_goal_paused(db: Session, goal_id: int):
     goal = get_goal(db, goal_id)
     if goal:
         if goal.is_paused == True:
             goal.is_paused = False
-            db.commit()
-            db.refresh(goal)
+            db.flush()
             update_can_check_in(db=db)
             return "Goal Unpaused"
         else:
             goal.is_paused = True
             goal.can_check_in = False
-            db.commit()
-            db.refresh(goal)
+            db.flush()
             return "Goal Paused"
     else:
         return "Goal not found"
@@ -424,13 +546,11 @@ def toggle_public_private(db: Session, goal_id: int):
     if goal:
         if goal.is_public:
             goal.is_public = False
-            db.commit()
-            db.refresh(goal)
+            db.flush()
             return "Goal now private!"
         else:
             goal.is_public = True
-            db.commit()
-            db.refresh(goal)
+            db.flush()
             return "Goal now public!"
     else:
         return "Goal not found"
@@ -439,8 +559,7 @@ def change_verified_status(db: Session, user_id: int, is_verified: bool):
     user = get_user(db, user_id)
     if user:
         user.is_verified = is_verified
-        db.commit()
-        db.refresh(user)
+        db.flush()
         return "Account status updated"
     else:
         return "User not found"
@@ -450,13 +569,11 @@ def toggle_goal_private(db: Session, goal_id: int):
     if goal:
         if goal.is_public == True:
             goal.is_public = False
-            db.commit()
-            db.refresh(goal)
+            db.flush()
             return "Goal set Private"
         else:
             goal.is_public = True
-            db.commit()
-            db.refresh(goal)
+            db.flush()
             return "Goal set Public"
 
 def after_check_in_update(goal_id: int, db: Session):
@@ -470,38 +587,62 @@ def after_check_in_update(goal_id: int, db: Session):
     db.query(models.Goal).filter(models.Goal.id == goal_id) \
         .update({'can_check_in': False})
 
-    db.commit()
+    db.flush()
     return
 
 def update_email_address(user_id: int, email: str, db: Session):
     user = get_user(db=db, user_id=user_id)
     user.email = email
-    db.commit()
-
-def update_email_address(user_id: int, email: str, db: Session):
-    user = get_user(db=db, user_id=user_id)
-    user.email = email
-    db.commit()
+    db.flush()
+    invalidate_principal(db, user_id)
 
 def update_username(user_id: int, username: str, db: Session):
     user = get_user(db=db, user_id=user_id)
     user.username = username
-    db.commit()
+    db.flush()
+    invalidate_principal(db, user_id)
 
-def update_password(user_id: int, newhash: str, newsalt: str, db: Session):
+def update_password(user_id: int, newhash: str, newsalt: str, db: Session, newcost: int | None = None):
     user = get_user(db=db, user_id=user_id)
     if user:
         user.pw_hash = newhash
         user.pw_salt = newsalt
-        db.commit()
+        user.pw_cost = newcost
+        db.flush()
+        invalidate_principal(db, user_id)
         return True
     return False
 
+# False when the token was already revoked; conditional, so of two concurrent
+# rotations of the same token only one gets True
+def revoke_refresh_token(db: Session, token_id: int):
+    revoked = db.query(models.RefreshToken).filter(models.RefreshToken.id == token_id) \
+        .filter(models.RefreshToken.revoked == False).update({'revoked': True}, synchronize_session=False)
+    db.flush()
+    return bool(revoked)
+
+def revoke_user_refresh_tokens(db: Session, user_id: int):
+    db.query(models.RefreshToken).filter(models.RefreshToken.user_id == user_id) \
+        .update({'revoked': True})
+    db.flush()
+
+# one UPDATE instead of read-modify-write: concurrent bumps do not get lost, and a
+# read from a lagging replica cannot produce a version the primary already has
+def bump_token_version(db: Session, user_id: int):
+    bumped = query_users(db).filter(models.User.id == user_id) \
+        .update({'token_version': func.coalesce(models.User.token_version, 0) + 1}, synchronize_session="fetch")
+    if not bumped:
+        return None
+    # the session has written, so this read goes to the primary (see database.RoutingSession)
+    token_version = db.query(models.User.token_version).filter(models.User.id == user_id).scalar()
+    invalidate_principal(db, user_id)
+    return token_version
+
 def update_goal_owner(db: Session, goal_id: int, user_id: int):
     goal = get_goal(db, goal_id)
     if goal:
         goal.creator_id = user_id
-        db.commit()
+        db.flush()
         return True
     return False
 
@@ -509,7 +650,7 @@ def make_group_goal(db: Session, goal_id: int):
     goal=get_goal(db, goal_id)
     if goal:
         goal.is_group_goal = True
-        db.commit()
+        db.flush()
         return True
     return False
 
@@ -519,14 +660,17 @@ def make_group_goal(db: Session, goal_id: int):
 
 ###############################################################################
 
+# The deletes below are set-based: one DELETE or UPDATE per table, children
+# first, however many rows the user has. The foreign keys also cascade, but
+# SQLite files created before the ON DELETE clauses were added keep their old
+# constraints, so the children are not left to them. Rows of these tables
+# already loaded into the session are not updated (synchronize_session=False).
+
 def delete_template(db: Session, template_id: int):
-    
-    for q in get_questions_by_template(db, template_id):
-        delete_question(db, q.question_id)
-    
-    deleted = db.query(models.Template).filter(models.Template.template_id == template_id).delete(synchronize_session="fetch")
+    db.query(models.Question).filter(models.Question.template_id == template_id).delete(synchronize_session=False)
+    deleted = db.query(models.Template).filter(models.Template.template_id == template_id).delete(synchronize_session=False)
     if deleted:
-        db.commit()
+        db.flush()
         return True
     else:
         return False
@@ -534,7 +678,7 @@ def delete_template(db: Session, template_id: int):
 def delete_question(db: Session, question_id: int):
     deleted = db.query(models.Question).filter(models.Question.question_id == question_id).delete(synchronize_session="fetch")
     if deleted:
-        db.commit()
+        db.flush()
         return True
     else:
         return False
@@ -542,7 +686,7 @@ def delete_question(db: Session, question_id: int):
 def delete_response(db: Session, response_id: int):
     deleted = db.query(models.Response).filter(models.Response.response_id == response_id).delete(synchronize_session="fetch")
     if deleted:
-        db.commit()
+        db.flush()
         return True
     else:
         return False
@@ -552,7 +696,7 @@ def delete_all_user_friendships(db: Session, user_id: int):
     deleted2=db.query(models.Friends).filter(models.Friends.user2 == user_id).delete(synchronize_session="fetch")
 
     if deleted1 and deleted2:
-        db.commit()
+        db.flush()
         return True
     else:
         return False
@@ -561,52 +705,146 @@ def delete_membership(db: Session, user_id: int):
     deleted=db.query(models.GroupMembers).filter(models.GroupMembers.user_id == user_id).delete(synchronize_session="fetch")
 
     if deleted:
-        db.commit()
+        db.flush()
         return True
     else:
         return False
 
-def delete_user(db: Session, user_id: int):
-
-    ##delete all friendships featuring user
-    delete_all_user_friendships(db, user_id)
-
-    ##remove user from groups
-    
-    for g in get_user_groups(db, user_id):
-        delete_membership(db, user_id)
+# the groups leaving users own go to the other member with the oldest account (the
+# lowest user id; groupMembers does not record when someone joined), along with
+# the groups' goals; the ones nobody else has joined stay
+def transfer_owned_groups(db: Session, user_ids: list[int]):
+    def next_owner(group_id):
+        return select(func.min(models.GroupMembers.user_id)) \
+            .where(models.GroupMembers.group_id == group_id) \
+            .where(models.GroupMembers.user_id.not_in(user_ids)) \
+            .where(models.GroupMembers.pending == False).scalar_subquery()
+
+    owned = select(models.Group.group_id).where(models.Group.creator_id.in_(user_ids))
+    db.query(models.Goal).filter(models.Goal.group_id.in_(owned)) \
+        .filter(next_owner(models.Goal.group_id).is_not(None)) \
+        .update({models.Goal.creator_id: next_owner(models.Goal.group_id)}, synchronize_session=False)
+    db.query(models.Group).filter(models.Group.creator_id.in_(user_ids)) \
+        .filter(next_owner(models.Group.group_id).is_not(None)) \
+        .update({models.Group.creator_id: next_owner(models.Group.group_id)}, synchronize_session=False)
+    db.flush()
+
+# what goes with the users, children first, as (model, which rows) pairs:
+# delete_users removes each in one statement, purge.py in batches of a bounded size
+def user_deletion_steps(user_ids: list[int]):
+    ##groups only the user was in go with their goals, memberships and the user's own goals
+    lone_groups = select(models.Group.group_id).where(models.Group.creator_id.in_(user_ids))
+    goals = select(models.Goal.id).where(or_(models.Goal.creator_id.in_(user_ids),
+                                             models.Goal.group_id.in_(lone_groups)))
+    ##comments by user and on the user's posts, then the posts
+    posts = select(models.Post.post_id).where(models.Post.post_author.in_(user_ids))
+    ##the user's templates with their questions; the ones other members' goals
+    ##or groups still use are kept without a creator
+    unused_templates = select(models.Template.template_id) \
+        .where(models.Template.creator_id.in_(user_ids)) \
+        .where(~exists().where(models.Goal.template_id == models.Template.template_id)) \
+        .where(~exists().where(models.Group.template_id == models.Template.template_id))
+    return [
+        (models.Response, models.Response.goal_id.in_(goals)),
+        (models.ArchivedResponse, models.ArchivedResponse.goal_id.in_(goals)),
+        (models.Goal, models.Goal.id.in_(goals)),
+        (models.GroupMembers, or_(models.GroupMembers.user_id.in_(user_ids),
+                                  models.GroupMembers.group_id.in_(lone_groups))),
+        (models.Group, models.Group.creator_id.in_(user_ids)),
+        (models.Friends, or_(models.Friends.user1.in_(user_ids), models.Friends.user2.in_(user_ids))),
+        (models.Comment, or_(models.Comment.comment_author.in_(user_ids), models.Comment.post_id.in_(posts))),
+        (models.Post, models.Post.post_author.in_(user_ids)),
+        (models.Question, models.Question.template_id.in_(unused_templates)),
+        (models.Template, models.Template.template_id.in_(unused_templates)),
+        (models.RefreshToken, models.RefreshToken.user_id.in_(user_ids)),
+    ]
+
+def goal_deletion_steps(goal_id: int):
+    return [(models.Response, models.Response.goal_id == goal_id),
+            (models.ArchivedResponse, models.ArchivedResponse.goal_id == goal_id)]
+
+# deletes the rows matching condition, or only the first limit of them
+def delete_rows(db: Session, model, condition, limit: int | None = None):
+    if limit is not None:
+        keys = inspect(model).primary_key
+        if len(keys) == 1:
+            condition = keys[0].in_(select(keys[0]).where(condition).limit(limit))
+        else:
+            condition = tuple_(*keys).in_(select(*keys).where(condition).limit(limit))
+    return db.query(model).filter(condition).delete(synchronize_session=False)
 
-    ##delete all posts by user, also deletes all comments associated with those posts
-    for p in get_posts_by_author(db, user_id):
-        delete_post(db, p.post_id)
+# the same statements for one user or a chunk of them, returns how many were deleted
+def delete_users(db: Session, user_ids: list[int]):
+    transfer_owned_groups(db, user_ids)
 
-    ##delete comments by user
-    for c in get_comments_by_author(db, user_id):
-        delete_comment(db, c.comment_id)
+    for model, condition in user_deletion_steps(user_ids):
+        delete_rows(db, model, condition)
+    db.query(models.Template).filter(models.Template.creator_id.in_(user_ids)) \
+        .update({models.Template.creator_id: None}, synchronize_session=False)
 
-    ##delete all templates by user, also deletes all questions associated with those templates
-    for t in get_template_by_creator(db, user_id):
-        delete_template(db, t.template_id)
-    
-    ##delete all goals by user, also deletes all responses associated with those goals
-    for g in get_user_goals_by_id(db, user_id):
-        delete_goal(db, g.id)
+    ##delete users
+    deleted=db.query(models.User).filter(models.User.id.in_(user_ids)).delete(synchronize_session=False)
+    invalidate_principals(db, user_ids)
+    db.flush()
+    return deleted
 
-    ##delete user
-    deleted=db.query(models.User).filter(models.User.id == user_id).delete(synchronize_session="fetch")
-    if deleted:
-        db.commit()
-        return True
-    else:
+def delete_user(db: Session, user_id: int):
+    return delete_users(db, [user_id]) == 1
+
+# Deleting an account or a goal only hides it: the row gets deleted_at, the
+# getters above leave it out, and a PurgeJob is queued for purge.py to remove
+# it with everything that hangs off it in the background.
+def soft_delete_user(db: Session, user_id: int):
+    # before the goals are hidden, the group goals move with their group
+    transfer_owned_groups(db, [user_id])
+    now = datetime.utcnow()
+    # the username and email are free for a new account right away
+    db.query(models.User).filter(models.User.id == user_id) \
+        .update({models.User.deleted_at: now, models.User.username: None, models.User.email: None},
+                synchronize_session="fetch")
+    db.query(models.Post).filter(models.Post.post_author == user_id).filter(models.Post.deleted_at.is_(None)) \
+        .update({models.Post.deleted_at: now}, synchronize_session="fetch")
+    db.query(models.Goal).filter(models.Goal.creator_id == user_id).filter(models.Goal.deleted_at.is_(None)) \
+        .update({models.Goal.deleted_at: now}, synchronize_session="fetch")
+    db.add(models.PurgeJob(kind="user", target_id=user_id, created_at=now))
+    invalidate_principal(db, user_id)
+    db.flush()
+    return True
+
+def soft_delete_goal(db: Session, goal_id: int):
+    now = datetime.utcnow()
+    hidden = db.query(models.Goal).filter(models.Goal.id == goal_id).filter(models.Goal.deleted_at.is_(None)) \
+        .update({models.Goal.deleted_at: now}, synchronize_session="fetch")
+    if not hidden:
         return False
+    db.add(models.PurgeJob(kind="goal", target_id=goal_id, created_at=now))
+    db.flush()
+    return True
+
+def get_purge_job(db: Session, job_id: int):
+    return db.get(models.PurgeJob, job_id)
+
+# oldest first
+# unfinished jobs that have failed fewer than max_attempts times, the ones that failed least first
+def get_pending_purge_jobs(db: Session, max_attempts: int | None = None):
+    jobs = db.query(models.PurgeJob.id).filter(models.PurgeJob.finished_at.is_(None))
+    if max_attempts is not None:
+        jobs = jobs.filter(func.coalesce(models.PurgeJob.attempts, 0) < max_attempts)
+    return jobs.order_by(func.coalesce(models.PurgeJob.attempts, 0), models.PurgeJob.id).all()
+
+def record_purge_failure(db: Session, job_id: int, error: str):
+    db.query(models.PurgeJob).filter(models.PurgeJob.id == job_id) \
+        .update({'attempts': func.coalesce(models.PurgeJob.attempts, 0) + 1, 'error': error[:500]},
+                synchronize_session=False)
+    db.flush()
 
 def delete_goal(db: Session, goal_id: int):
-    for r in get_responses_by_goal(db, goal_id):
-        delete_response(db, r.response_id)
+    for model, condition in goal_deletion_steps(goal_id):
+        delete_rows(db, model, condition)
 
     deleted=db.query(models.Goal).filter(models.Goal.id == goal_id).delete(synchronize_session="fetch")
     if deleted:
-        db.commit()
+        db.flush()
         return True
     else:
         return False
@@ -614,32 +852,52 @@ def delete_goal(db: Session, goal_id: int):
 def delete_comment(db: Session, comment_id: int):
     deleted=db.query(models.Comment).filter(models.Comment.comment_id == comment_id).delete(synchronize_session="fetch")
     if deleted:
-        db.commit()
+        db.flush()
         return True
     else:
         return False
 
 def delete_post(db: Session, post_id: int):
     ### delete comments associated with the post
-    for c in get_comments_by_post(db, post_id):
-        delete_comment(db, c.comment_id)
+    db.query(models.Comment).filter(models.Comment.post_id == post_id).delete(synchronize_session=False)
 
     deleted=db.query(models.Post).filter(models.Post.post_id == post_id).delete(synchronize_session="fetch")
     if deleted:
-        db.commit()
+        db.flush()
         return True
     else:
         return False
 
-def delete_not_verified_users(db: Session):
-    users = get_not_verified_users(db)
-    for user in users:
-        if ((date.today() - user.verification_sent_date) > timedelta(days=5)):
-            delete_user(db, user.id)
+# users who have not verified their email this many days after it was sent are deleted
+UNVERIFIED_USER_DAYS = 5
+
+# the next limit expired users after after_id, a page of the backlog that
+# purge.purge_unverified_users deletes one transaction at a time
+def get_not_verified_user_ids(db: Session, after_id: int, limit: int):
+    sent_before = date.today() - timedelta(days=UNVERIFIED_USER_DAYS)
+    return [row.id for row in db.query(models.User.id).filter(models.User.is_verified == False)
+            .filter(models.User.verification_sent_date < sent_before)
+            .filter(models.User.deleted_at.is_(None)).filter(models.User.id > after_id)
+            .order_by(models.User.id).limit(limit)]
+
+def delete_expired_token_revocations(db: Session):
+    db.query(models.TokenRevocation).filter(models.TokenRevocation.expires_at <= datetime.utcnow()) \
+        .delete(synchronize_session=False)
+    db.flush()
+
+def delete_expired_redeemed_tokens(db: Session):
+    db.query(models.RedeemedToken).filter(models.RedeemedToken.expires_at <= datetime.utcnow()) \
+        .delete(synchronize_session=False)
+    db.flush()
+
+def delete_expired_refresh_tokens(db: Session):
+    db.query(models.RefreshToken).filter(models.RefreshToken.expires_at <= datetime.utcnow()) \
+        .delete(synchronize_session=False)
+    db.flush()
 
 def delete_group(db: Session, group_id: int):
     deleted = db.query(models.Group).filter(models.Group.group_id == group_id).delete(synchronize_session="fetch")
     if deleted:
-        db.commit()
+        db.flush()
         return True
     return False
@@ -1,8 +1,8 @@
 from email.message import EmailMessage
 from email.utils import formataddr
-from database import get_database
+from database import session_scope
 from models import User, Goal, Question, Response
-from crud import get_user, get_checkin_goals, get_responses_by_goal, get_question
+from crud import get_user, get_checkin_goals, get_responses_by_check_in, get_question
 from datetime import date
 from pydantic import BaseModel
 
@@ -58,38 +58,38 @@ def createCheckinMessage(emaildata: Emaildata):
     return msg   
 
 def generate_list_email_data():
-    emaildata_s : list(Emaildata) = list()
-    #print(emaildata_s)
-    db = next(get_database())
-    goals: list[Goal] = get_checkin_goals(db)
+    # a session of its own, closed again even when building the emails fails
+    with session_scope() as db:
+        emaildata_s : list(Emaildata) = list()
+        #print(emaildata_s)
+        goals: list[Goal] = get_checkin_goals(db)
     
-    # if no goals
-    if not goals:
-        return None
-
-    for goal in goals:
-        user: User = get_user(db, goal.creator_id)
-        #print(f"{user.username}, {user.email}")
-        #url = f"http://localhost:3000/email/{user.username}/{goal.id}"
-        url = "http://localhost:3000/login"
-        responses: list[Response] = get_responses_by_goal(db, goal.id)
-        # filter responses to only have responses with previous check_in_num
-        responses = [response for response in responses if response.check_in_number == goal.check_in_num]
-
-        #print(url)
-        # get responses and associated questions
-        qa_s = list()
-        for response in responses:
-            question: Question = get_question(db, response.goal_id)
-            qa = [question.text, response.text]
-            qa_s.append(qa)
-
-        #print(qa_s)
-        remainder = False if goal.next_check_in == date.today() else True
-
-        data = Emaildata(user = user.username,email = user.email, url = url, questions_answers= qa_s, remainder=remainder)
-        emaildata_s.append(data)
-    return emaildata_s 
+        # if no goals
+        if not goals:
+            return None
+
+        for goal in goals:
+            user: User = get_user(db, goal.creator_id)
+            #print(f"{user.username}, {user.email}")
+            #url = f"http://localhost:3000/email/{user.username}/{goal.id}"
+            url = "http://localhost:3000/login"
+            # only the responses of the previous check_in_num
+            responses: list[Response] = get_responses_by_check_in(db, goal.id, goal.check_in_num)
+
+            #print(url)
+            # get responses and associated questions
+            qa_s = list()
+            for response in responses:
+                question: Question = get_question(db, response.goal_id)
+                qa = [question.text, response.text]
+                qa_s.append(qa)
+
+            #print(qa_s)
+            remainder = False if goal.next_check_in == date.today() else True
+
+            data = Emaildata(user = user.username,email = user.email, url = url, questions_answers= qa_s, remainder=remainder)
+            emaildata_s.append(data)
+        return emaildata_s 
 
 def createNotificationMessage(email: str, user: str, commentuser: str, comment: str, posttitle: str):
     msg = EmailMessage()
@@ -98,6 +98,41 @@ NonexistentGroupRequestException = HTTPException(
     detail="Group invite does not exist"
 )
 
+InvalidRefreshTokenException = HTTPException(
+    status_code=status.HTTP_401_UNAUTHORIZED,
+    detail="Invalid refresh token",
+    headers={"WWW-Authenticate": "Bearer"},
+)
+
+def TooManyRequestsException(retry_after: int):
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many requests, please try again later",
+        headers={"Retry-After": str(retry_after)}
+    )
+
+PasswordEngineBusyException = HTTPException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="Server is busy, please try again shortly",
+    headers={"Retry-After": "1"}
+)
+
+WriteQueueBusyException = HTTPException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="Server is busy, please try again shortly",
+    headers={"Retry-After": "1"}
+)
+
+MetricsForbiddenException = HTTPException(
+    status_code=status.HTTP_403_FORBIDDEN,
+    detail="Not allowed to read metrics"
+)
+
+InvalidCursorException = HTTPException(
+    status_code=status.HTTP_400_BAD_REQUEST,
+    detail="Invalid cursor"
+)
+
 
 
 
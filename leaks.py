@@ -0,0 +1,103 @@
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import event
+from starlette.concurrency import run_in_threadpool
+
+from sql_metrics import calling_function
+
+# Finds sessions and connections that are not given back. Every engine made by
+# database.create_db_engine is watched:
+#   - a connection checked out for longer than LEAK_CHECKOUT_SECONDS is logged to
+#     "sql.leaks" when it is returned, and listed by /metrics while it is still out,
+#     with the crud/main function that checked it out
+#   - SessionLeakMiddleware looks at the sessions a request opened (see
+#     main.enlist_session) once the request is over; one still in a transaction
+#     was not closed by its dependency, it is reported and closed
+
+LEAK_CHECKOUT_SECONDS = float(os.getenv("LEAK_CHECKOUT_SECONDS", 30))
+
+leak_log = logging.getLogger("sql.leaks")
+
+
+class LeakDetector:
+    def __init__(self, checkout_seconds: float = LEAK_CHECKOUT_SECONDS):
+        self.checkout_seconds = checkout_seconds
+        self._lock = threading.Lock()
+        # id of the pool's connection record -> (monotonic checkout time, caller)
+        self._checked_out = {}
+        self.long_checkouts = 0
+        self.leaked_sessions = 0
+
+    def watch(self, engine):
+        @event.listens_for(engine, "checkout")
+        def connection_checked_out(dbapi_connection, connection_record, connection_proxy):
+            with self._lock:
+                self._checked_out[id(connection_record)] = (time.monotonic(), calling_function())
+
+        @event.listens_for(engine, "checkin")
+        def connection_checked_in(dbapi_connection, connection_record):
+            with self._lock:
+                entry = self._checked_out.pop(id(connection_record), None)
+            if entry is None:
+                return
+            held = time.monotonic() - entry[0]
+            if held >= self.checkout_seconds:
+                with self._lock:
+                    self.long_checkouts += 1
+                leak_log.warning("connection held for %.1f s, checked out in %s", held, entry[1] or "?")
+
+    def held_too_long(self):
+        now = time.monotonic()
+        with self._lock:
+            return [{"held_seconds": round(now - since, 3), "checked_out_in": caller}
+                    for since, caller in self._checked_out.values() if now - since >= self.checkout_seconds]
+
+    def report_session(self, endpoint: str):
+        with self._lock:
+            self.leaked_sessions += 1
+        leak_log.warning("session still open at the end of %s", endpoint)
+
+    def stats(self):
+        held_too_long = self.held_too_long()
+        with self._lock:
+            return {"checked_out": len(self._checked_out),
+                    "held_too_long": held_too_long,
+                    "long_checkouts": self.long_checkouts,
+                    "leaked_sessions": self.leaked_sessions}
+
+    def reset(self):
+        with self._lock:
+            self.long_checkouts = 0
+            self.leaked_sessions = 0
+
+
+leak_detector = LeakDetector()
+
+
+async def close_session(db):
+    if hasattr(db, "sync_session"):
+        await db.close()
+    else:
+        await run_in_threadpool(db.close)
+
+
+class SessionLeakMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            # the dependencies have been torn down by now
+            for db in scope.get("state", {}).get("db_sessions", []):
+                if db.in_transaction():
+                    leak_detector.report_session("{method} {path}".format(method=scope["method"],
+                                                                          path=scope["path"]))
+                    await close_session(db)
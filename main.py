@@ -11,25 +11,134 @@ from fastapi.middleware import Middleware
 from jose import JWTError, jwt
 from datetime import date, datetime, timedelta
 from functools import wraps
-import bcrypt
+import ast
+import hashlib
+import logging
+import os
+import secrets
 from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool
 import exceptions
-from database import get_database
+from database import SessionLocal, pool_metrics, AsyncSessionLocal, async_engine, replica_engine, read_from_primary
+from principal_cache import principal_cache
+from password_engine import password_engine
+from revocation import revocation_index
+from redeemed_tokens import redeemed_tokens
+from ratelimit import rate_limit
+from auth import AuthMiddleware
+from sql_metrics import SQLMetricsMiddleware, sql_metrics
+from pagination import DEFAULT_PAGE_SIZE, set_next_cursor
+from leaks import SessionLeakMiddleware, leak_detector
+from write_queue import write_coordinator
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import asyncio
 from email_sender import emailVerification, resetpassVerification, sendNotification
 
 # DATABASE
-from fastapi import Depends, FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Header
 from sqlalchemy.orm import Session
-import crud, models, schemas
+from sqlalchemy.ext.asyncio import AsyncSession
+import crud, async_crud, models, schemas, migrations
 from database import engine
 
 models.Base.metadata.create_all(bind=engine)
+migrations.run_migrations(engine, models.Base.metadata)
 
 Base2 = models.Base
 
 
-def get_db():
-    return next(get_database())
+# reads go to the replica (if one is configured) unless the requesting user wrote
+# in the last few seconds, see database.RoutingSession
+def request_sticky_key(request: Request):
+    claims = getattr(request.state, "claims", None)
+    return claims.get("sub") if claims else None
+
+
+# A request is one transaction: crud functions only flush, and UnitOfWorkRoute
+# commits every session the request opened once the handler has returned a
+# success, or rolls them back when it raised or answered with an error status.
+# The commit happens before the response is sent, so a client never sees a
+# success for a write that did not make it.
+def enlist_session(request: Request, db):
+    if not hasattr(request.state, "db_sessions"):
+        request.state.db_sessions = []
+    request.state.db_sessions.append(db)
+    return db
+
+
+def get_db(request: Request):
+    db = SessionLocal(sticky_key=request_sticky_key(request))
+    try:
+        yield enlist_session(request, db)
+    finally:
+        db.close()
+
+
+# for async handlers: runs on the event loop instead of holding a threadpool thread
+async def get_async_db(request: Request):
+    async with AsyncSessionLocal(sticky_key=request_sticky_key(request)) as db:
+        yield enlist_session(request, db)
+
+
+async def end_transaction(db, commit: bool):
+    # a flush that failed inside the handler (and was caught there) leaves the
+    # session needing a rollback, nothing of it can be committed
+    commit = commit and db.is_active
+    if isinstance(db, AsyncSession):
+        await (db.commit() if commit else db.rollback())
+    else:
+        await run_in_threadpool(db.commit if commit else db.rollback)
+
+
+class UnitOfWorkRoute(APIRoute):
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def unit_of_work_handler(request: Request):
+            try:
+                response = await handler(request)
+            except Exception:
+                for db in getattr(request.state, "db_sessions", []):
+                    await end_transaction(db, commit=False)
+                raise
+            for db in getattr(request.state, "db_sessions", []):
+                await end_transaction(db, commit=response.status_code < 400)
+            return response
+
+        return unit_of_work_handler
+
+
+# The writes of the busiest endpoints (check-ins, responses, comments) go through
+# write_coordinator's group commit when WRITE_QUEUE is on, see write_queue.py,
+# and are committed before the handler carries on; otherwise they are part of
+# the request's transaction. operation(db) does the writing and returns plain
+# values. The request's own session only reads here; it is committed first so it
+# holds no transaction while the writer thread commits (get_current_user has
+# already ended the transaction of the session it authenticated with).
+# A write not done within the queue's timeout answers 503; if it was still
+# queued it is dropped, one the writer had started may still be committed.
+def write(request: Request, db: Session, operation):
+    if not write_coordinator.enabled:
+        return operation(db)
+    db.commit()
+    future = write_coordinator.submit(operation, sticky_key=request_sticky_key(request))
+    try:
+        return future.result(timeout=write_coordinator.timeout_seconds)
+    except FutureTimeoutError:
+        future.cancel()
+        raise exceptions.WriteQueueBusyException
+
+
+async def write_async(request: Request, db: AsyncSession, operation):
+    if not write_coordinator.enabled:
+        return await db.run_sync(operation)
+    await db.commit()
+    try:
+        # cancelling the wait cancels the queued write
+        return await asyncio.wait_for(write_coordinator.run(operation, sticky_key=request_sticky_key(request)),
+                                      write_coordinator.timeout_seconds)
+    except asyncio.TimeoutError:
+        raise exceptions.WriteQueueBusyException
 
 
 def is_running_tests():
@@ -57,11 +166,17 @@ SECRET_KEY = "09d25e094faa6ca2556c818166b7a9563b93f7099f6f0f4caa6cf63b88e8d3e7"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 ACCESS_TOKEN_EXPIRE_DAYS = 5
+REFRESH_TOKEN_EXPIRE_DAYS = 30
 
 
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: str | None = None
+
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
@@ -75,31 +190,114 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     return encoded_jwt
 
 
-# method used to be async
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+# refresh tokens are random, long-lived and only stored as a sha256 digest.
+# A digest (not bcrypt) is enough since they carry 256 bits of entropy.
+def hash_refresh_token(refresh_token: str):
+    return hashlib.sha256(refresh_token.encode('utf-8')).hexdigest()
+
+
+def issue_refresh_token(db: Session, user_id: int):
+    refresh_token = secrets.token_urlsafe(32)
+    crud.create_refresh_token(db=db, user_id=user_id, token_hash=hash_refresh_token(refresh_token),
+                              expires_at=datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS))
+    return refresh_token
+
+
+def create_auth_tokens(db: Session, user: models.User):
+    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    # jti lets a single token be revoked, ver lets all of a user's tokens be revoked at once
+    access_token = create_access_token(
+        data={"sub": user.username, "typ": "auth", "jti": secrets.token_urlsafe(16),
+              "ver": user.token_version or 0},
+        expires_delta=access_token_expires
+    )
+    return {"access_token": access_token, "token_type": "bearer",
+            "refresh_token": issue_refresh_token(db, user.id)}
+
+
+# email verification and password reset links carry a single-use token
+def create_single_use_token(user: models.User, typ: str, expires_delta: timedelta):
+    return create_access_token(
+        data={"sub": user.username, "uid": user.id, "typ": typ, "jti": secrets.token_urlsafe(16)},
+        expires_delta=expires_delta
+    )
+
+
+def single_use_claims(token: str, payload: dict):
+    """returns (username, user_id, jti) of a verification/reset token, otherwise None"""
+    sub_payload = payload.get("sub")
+    if "uid" in payload:
+        username, user_id = sub_payload, payload["uid"]
+    else:
+        # links sent before the claims were structured have sub = str({"user": .., "id": ..})
+        try:
+            sub_payload = ast.literal_eval(sub_payload)
+        except (ValueError, SyntaxError, TypeError):
+            return None
+        if not isinstance(sub_payload, dict):
+            return None
+        username, user_id = sub_payload.get("user"), sub_payload.get("id")
+    if not isinstance(username, str) or not isinstance(user_id, int):
+        return None
+    # old tokens have no jti, the token itself identifies them
+    jti = payload.get("jti") or hash_refresh_token(token)
+    return username, user_id, jti
+
+
+def revoke_all_tokens(db: Session, user_id: int):
+    # access tokens through the revocation index, refresh tokens in the db
+    revocation_index.revoke_user(db, user_id,
+                                 expires_at=datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+    crud.revoke_user_refresh_tokens(db, user_id)
+
+
+# AuthMiddleware has already verified the token and left its claims (and, when the
+# principal cache had it, the user) on request.state; this turns that into a user
+# with at most one query, and FastAPI caches the result for the rest of the request.
+# It is async so authenticating does not take a threadpool thread; the session only
+# connects when the principal or the revocation index has to be loaded, and its
+# transaction is ended as soon as the user is known: otherwise it would keep its
+# read lock until the request commits, and under SQLite's rollback journal no
+# write of the request (or of the write queue) could commit before then.
+async def get_current_user(request: Request, token: str = Depends(oauth2_scheme),
+                           db: AsyncSession = Depends(get_async_db)):
+    try:
+        return await load_current_user(request, token, db)
+    finally:
+        await db.commit()
+
+
+async def load_current_user(request: Request, token: str, db: AsyncSession):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        type_payload: str = payload.get("typ")
-        if type_payload is None:
-            raise credentials_exception
-        if type_payload != "auth":
-            raise credentials_exception
-        if username is None:
-            raise credentials_exception
-        token_data = TokenData(username=username)
-    except JWTError:
+    payload = getattr(request.state, "claims", None)
+    if payload is None:
+        # a public path that still asked for a user
         raise credentials_exception
-    user = crud.get_user_by_username(db, username)
+    current_user = getattr(request.state, "user", None)
+    if current_user is not None:
+        # in-memory check, the index only reads the db every few seconds
+        if await revocation_index.is_revoked_async(db, current_user.id, payload.get("jti"),
+                                                   current_user.token_version):
+            principal_cache.invalidate_token(token)
+            raise credentials_exception
+        return current_user
 
+    user = await async_crud.get_user_by_username(db, payload["sub"])
     if user is None:
         raise credentials_exception
-    return user
+    # tokens issued before the last revoke_user carry an older version
+    if payload.get("ver", 0) != (user.token_version or 0):
+        raise credentials_exception
+    if await revocation_index.is_revoked_async(db, user.id, payload.get("jti"), user.token_version or 0):
+        raise credentials_exception
+    current_user = schemas.UserSnapshot.from_orm(user)
+    principal_cache.put(token, current_user, payload)
+    request.state.user = current_user
+    return current_user
 
 
 def verify_access_token(token: str, username: str):
@@ -132,26 +330,72 @@ middleware = [
         allow_origins=origins,
         allow_credentials=True,
         allow_methods=["*"],
-        allow_headers=["*"]
+        allow_headers=["*"],
+        expose_headers=["X-Next-Cursor"]
     )
 ]
 
-app = FastAPI(middleware=middleware)
+middleware.append(Middleware(AuthMiddleware, secret_key=SECRET_KEY, algorithm=ALGORITHM))
+middleware.append(Middleware(SQLMetricsMiddleware))
+middleware.append(Middleware(SessionLeakMiddleware))
 
+app = FastAPI(middleware=middleware)
 
-# app.router.route_class = IsLoggedIn
+app.router.route_class = UnitOfWorkRoute
 
 
 # CORS STUFF
 
+@app.on_event("startup")
+def calibrate_password_engine():
+    password_engine.target_cost()
+
+
+@app.on_event("shutdown")
+def shutdown_password_engine():
+    password_engine.shutdown()
+
+
+@app.on_event("shutdown")
+def shutdown_write_coordinator():
+    write_coordinator.stop()
+
+
 @app.get("/")
 @measure_time
 def root():
     return {"message": "Welcome to MAP website"}
 
 
+# /metrics shows per endpoint SQL, slow query call sites and pool internals, so it
+# is only served with an X-Metrics-Token header matching METRICS_TOKEN, and not
+# at all while METRICS_TOKEN is unset. It is not behind the user login.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+
+def metrics_token():
+    return METRICS_TOKEN
+
+
+def require_metrics_token(x_metrics_token: str | None = Header(None), expected: str | None = Depends(metrics_token)):
+    if not expected or not x_metrics_token or not secrets.compare_digest(x_metrics_token, expected):
+        raise exceptions.MetricsForbiddenException
+
+
+# connection pool and principal cache numbers, for sizing DB_POOL_SIZE against the worker count
+@app.get("/metrics", dependencies=[Depends(require_metrics_token)])
+def metrics():
+    return {"database_pool": pool_metrics(engine),
+            "async_database_pool": pool_metrics(async_engine.sync_engine),
+            "replica_pool": pool_metrics(replica_engine) if replica_engine is not engine else None,
+            "principal_cache": principal_cache.stats(),
+            "sql": sql_metrics.stats(),
+            "leaks": leak_detector.stats(),
+            "write_queue": write_coordinator.stats()}
+
+
 # trying post request
-@app.post("/signup")
+@app.post("/signup", dependencies=[Depends(rate_limit("signup"))])
 @measure_time
 def signup(user: User, response: Response, db: Session = Depends(get_db),
            skip_for_testing: bool = Depends(is_running_tests)):
@@ -178,17 +422,13 @@ def signup(user: User, response: Response, db: Session = Depends(get_db),
 
     # IS A NEW USER
 
-    # generate a salt
-    salt = bcrypt.gensalt(12)
-    # combine and generate the pass hash
-    passhash = bcrypt.hashpw(user.password.encode('utf-8'), salt)
-    salt = salt.decode('utf-8')
-    passhash = passhash.decode('utf-8')
+    # generate a salt and the pass hash (off the request thread)
+    passhash, salt, cost = password_engine.hash_password(user.password)
     # print(f"{salt} {passhash}")
 
     # make a schema
     new_user = schemas.UserCreate(email=user.email, username=user.username,
-                                  pw_hash=passhash, pw_salt=salt)
+                                  pw_hash=passhash, pw_salt=salt, pw_cost=cost)
     new_user = crud.create_user(db, new_user)
 
     # if not successful database transaction
@@ -200,15 +440,7 @@ def signup(user: User, response: Response, db: Session = Depends(get_db),
     # generate JWT token for email verification
     access_token_expires = timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS)
     # sub has to be string
-    access_token = create_access_token(
-        data={"sub": str({
-            "user": new_user.username,
-            "id": new_user.id
-        }),
-            "typ": "email_verification"
-        }
-        , expires_delta=access_token_expires
-    )
+    access_token = create_single_use_token(new_user, "email_verification", access_token_expires)
     if skip_for_testing or len(new_user.username) == 1:
         crud.change_verified_status(db=db, user_id=new_user.id, is_verified=True)
     else:
@@ -216,8 +448,7 @@ def signup(user: User, response: Response, db: Session = Depends(get_db),
         sent = emailVerification(email=user.email, user=user.username, token=access_token)
 
         if not sent:
-            # delete the created user
-            crud.delete_user(db=db, user_id=new_user.id)
+            # the 500 rolls the new user back
             message = {"message": "Error Occurred while creating the user"}
             response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
             return message
@@ -236,9 +467,6 @@ def signup(user: User, response: Response, db: Session = Depends(get_db),
 def verify_email(q: str, response: Response, db: Session = Depends(get_db)):
     try:
         payload = jwt.decode(token=q, key=SECRET_KEY, algorithms=[ALGORITHM])
-        sub_payload: str = payload.get("sub")
-        # convert string back to dict to retrieve user and user_id
-        sub_payload: dict = eval(sub_payload)
         type_payload: str = payload.get("typ")
 
         if type_payload == None:
@@ -251,8 +479,18 @@ def verify_email(q: str, response: Response, db: Session = Depends(get_db)):
             response.status_code = status.HTTP_401_UNAUTHORIZED
             return message
 
-        user: str = sub_payload.get("user")
-        user_id: int = sub_payload.get("id")
+        claims = single_use_claims(q, payload)
+        if claims is None:
+            message = {"message": "Bad credentials/sub"}
+            response.status_code = status.HTTP_401_UNAUTHORIZED
+            return message
+        user, user_id, jti = claims
+
+        # a link clicked again is answered from memory
+        if redeemed_tokens.is_redeemed(jti):
+            message = {"message": "User Email already verified"}
+            response.status_code = status.HTTP_200_OK
+            return message
 
         db_user = crud.get_user(db, user_id)
 
@@ -266,7 +504,7 @@ def verify_email(q: str, response: Response, db: Session = Depends(get_db)):
             response.status_code = status.HTTP_401_UNAUTHORIZED
             return message
 
-        if db_user.is_verified:
+        if db_user.is_verified or not redeemed_tokens.redeem(db, jti, datetime.utcfromtimestamp(payload["exp"])):
             message = {"message": "User Email already verified"}
             response.status_code = status.HTTP_200_OK
             return message
@@ -287,7 +525,10 @@ def verify_email(q: str, response: Response, db: Session = Depends(get_db)):
 
 
 def verify_password(plain_password, hashed_password):
-    return bcrypt.checkpw(plain_password.encode('utf8'), hashed_password.encode('utf8'))
+    return password_engine.verify_password(plain_password, hashed_password)
+
+
+rehash_log = logging.getLogger("password_engine")
 
 
 def authenticate_user(db, username: str, password: str):
@@ -300,13 +541,27 @@ def authenticate_user(db, username: str, password: str):
     if not verify_password(password, user.pw_hash):
         # print("failed to verify")
         return False
+    # the password is known to be right here, so move it to the current target cost;
+    # only when the password engine has room, the next login can do it otherwise
+    if password_engine.needs_rehash(user.pw_hash, user.pw_cost):
+        try:
+            passhash, salt, cost = password_engine.hash_password(password)
+        except HTTPException as e:
+            if e is not exceptions.PasswordEngineBusyException:
+                raise
+            rehash_log.info("password engine busy, rehash of user %d skipped", user.id)
+        else:
+            crud.update_password(user_id=user.id, newhash=passhash, newsalt=salt, db=db, newcost=cost)
     return user
 
 
 # this function used to be async
-@app.post("/token", response_model=Token)
+# The user is read from the primary: right after /change_password a lagging
+# replica would still accept the old password and hand out the old token_version.
+@app.post("/token", response_model=Token, dependencies=[Depends(rate_limit("token"))])
 @measure_time
 def login_for_access_token(db: Session = Depends(get_db), form_data: OAuth2PasswordRequestForm = Depends()):
+    read_from_primary(db)
     user = authenticate_user(db, form_data.username, form_data.password)
 
     if not user:
@@ -323,46 +578,89 @@ def login_for_access_token(db: Session = Depends(get_db), form_data: OAuth2Passw
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    return create_auth_tokens(db, user)
 
-    access_token = create_access_token(
-        data={"sub": user.username, "typ": "auth"}, expires_delta=access_token_expires
-    )
 
-    return {"access_token": access_token, "token_type": "bearer"}
+# trade a refresh token for a new access token without the password (and bcrypt).
+# Refresh tokens rotate: each one works once and is replaced by the one returned here.
+@app.post("/token/refresh", response_model=Token)
+@measure_time
+def refresh_access_token(body: RefreshRequest, db: Session = Depends(get_db)):
+    # like a login, the token and the user's token_version must not lag
+    read_from_primary(db)
+    refresh_token = crud.get_refresh_token(db, hash_refresh_token(body.refresh_token))
+    if not refresh_token or refresh_token.expires_at <= datetime.utcnow():
+        raise exceptions.InvalidRefreshTokenException
+    user = crud.get_user(db, refresh_token.user_id)
+    if not user:
+        raise exceptions.InvalidRefreshTokenException
+    # only one of two concurrent refreshes with the same token gets to rotate it
+    if not crud.revoke_refresh_token(db, refresh_token.id):
+        # a rotated token came back, so it has leaked: end every session of the user.
+        # Committed here, the error response would roll it back.
+        crud.revoke_user_refresh_tokens(db, refresh_token.user_id)
+        db.commit()
+        raise exceptions.InvalidRefreshTokenException
+    return create_auth_tokens(db, user)
+
+
+# revokes the access token used for the call and, when given, its refresh token
+@app.post("/logout")
+@measure_time
+def logout(request: Request, body: RefreshRequest | None = None, token: str = Depends(oauth2_scheme),
+           db: Session = Depends(get_db), current_user: schemas.UserSnapshot = Depends(get_current_user)):
+    payload = request.state.claims
+    if payload.get("jti"):
+        revocation_index.revoke_token(db, current_user.id, payload["jti"],
+                                      expires_at=datetime.utcfromtimestamp(payload["exp"]))
+    principal_cache.invalidate_token(token)
+    if body is not None:
+        refresh_token = crud.get_refresh_token(db, hash_refresh_token(body.refresh_token))
+        if refresh_token and refresh_token.user_id == current_user.id:
+            crud.revoke_refresh_token(db, refresh_token.id)
+    message = {"detail": "logged out"}
+    return message
 
 
-def verify_username_and_goal(username: str, goal_id: int, response: Response,
-                             db: Session):
-    user = crud.get_user_by_username(db=db, username=username)
+# ownership checks: load the goal/post named in the path once, check it belongs to
+# the caller and hand the loaded row to the handler. crud.get_goal and
+# crud.get_post_by_id go through the session's identity map, so crud helpers that
+# take the id again do not query for it a second time.
+def get_owned_goal(goal_id: int, db: Session = Depends(get_db),
+                   current_user: schemas.UserSnapshot = Depends(get_current_user)):
     goal = crud.get_goal(db=db, goal_id=goal_id)
     if not goal:
         raise exceptions.NonexistentGoalException
-    if goal.creator_id != user.id:
+    if goal.creator_id != current_user.id:
         raise exceptions.ForbiddenGoalException
+    return goal
 
 
-def verify_username_and_post(username: str, post_id: int, response: Response,
-                             db: Session):
-    user = crud.get_user_by_username(db=db, username=username)
+def get_owned_post(post_id: int, db: Session = Depends(get_db),
+                   current_user: schemas.UserSnapshot = Depends(get_current_user)):
     post = crud.get_post_by_id(db=db, post_id=post_id)
     if not post:
         raise exceptions.NonexistentForumPostException
-    if post.post_author != user.id:
+    if post.post_author != current_user.id:
         raise exceptions.ForbiddenForumPostException
-    return True
+    return post
 
 
 @app.get("/user/me")
 @measure_time
-def home(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def home(db: Session = Depends(get_db), current_user: schemas.UserSnapshot = Depends(get_current_user)):
     return {"username": current_user.username}
 
 
-@app.get("/goals")
+# list endpoints are paginated: pass the X-Next-Cursor response header back as
+# ?cursor= for the next page, see pagination.py
+@app.get("/goals", response_model=schemas.GoalList)
 @measure_time
-def home(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
-    return {"message": crud.get_unachieved_goals(db=db, username=current_user.username)}
+def home(response: Response, db: Session = Depends(get_db), cursor: str | None = None,
+         limit: int = DEFAULT_PAGE_SIZE, current_user: schemas.UserSnapshot = Depends(get_current_user)):
+    goals = crud.get_unachieved_goals(db=db, user_id=current_user.id, cursor=cursor, limit=limit)
+    set_next_cursor(response, goals)
+    return {"message": goals}
 
 
 class SmallResponse(BaseModel):
@@ -381,12 +679,7 @@ class BigGoal(BaseModel):
 @app.post("/create_specific_goal")
 @measure_time
 def create_specific_goal(goaljson: BigGoal, response: Response, db: Session = Depends(get_db),
-                         current_user: models.User = Depends(get_current_user)):
-    user = crud.get_user_by_username(db=db, username=current_user.username)
-    if not user:
-        message = {"message": "user does not exist"}
-        response.status_code = status.HTTP_400_BAD_REQUEST
-        return message
+                         current_user: schemas.UserSnapshot = Depends(get_current_user)):
     template = crud.get_template(db=db, template_id=goaljson.template_id)
     if not template:
         message = {"message": "template does not exist"}
@@ -396,7 +689,7 @@ def create_specific_goal(goaljson: BigGoal, response: Response, db: Session = De
     goal = crud.create_goal(db=db, goal_name=goaljson.goal_name,
                             check_in_period=goaljson.check_in_period,
                             template_id=goaljson.template_id,
-                            user_id=user.id, is_group=goaljson.is_group)
+                            user_id=current_user.id, is_group=goaljson.is_group)
 
     for answer in goaljson.responses:
         question = crud.get_question(db=db, question_id=answer.question_id)
@@ -423,7 +716,7 @@ class BigCustomGoal(BaseModel):
 @measure_time
 def create_custom_goal(goaljson: BigCustomGoal,
                        response: Response, db: Session = Depends(get_db),
-                       current_user: models.User = Depends(get_current_user)):
+                       current_user: schemas.UserSnapshot = Depends(get_current_user)):
     # print(goaljson.questions_answers)
     if not current_user:
         message = {"message": "user not found"}
@@ -462,7 +755,7 @@ def create_custom_goal(goaljson: BigCustomGoal,
 @measure_time
 def create_template(template: schemas.TemplateCreate,
                     response: Response, db: Session = Depends(get_db),
-                    current_user: models.User = Depends(get_current_user)):
+                    current_user: schemas.UserSnapshot = Depends(get_current_user)):
     if not current_user:
         message = {"message": "error: user not found"}
         response.status_code = status.HTTP_403_FORBIDDEN
@@ -485,7 +778,7 @@ class GoalInfo(BaseModel):
 @app.get("/progress/{goal_id}")
 @measure_time
 def view_goal_progress(goal_id: int, response: Response, db: Session = Depends(get_db),
-                       current_user: models.User = Depends(get_current_user)):
+                       current_user: schemas.UserSnapshot = Depends(get_current_user)):
     goal = crud.get_goal(db=db, goal_id=goal_id)
     if not goal:
         message = {"message": "error: goal not found"}
@@ -509,9 +802,12 @@ def view_goal_progress(goal_id: int, response: Response, db: Session = Depends(g
 
 @app.get("/templates", response_model=list[schemas.Template])
 @measure_time
-def view_premade_templates(db: Session = Depends(get_db), skip: int = 0, limit: int = 100,
-                           current_user: models.User = Depends(get_current_user)):
-    return crud.get_premade_templates(db=db, skip=skip, limit=limit)
+def view_premade_templates(response: Response, db: Session = Depends(get_db), cursor: str | None = None,
+                           limit: int = DEFAULT_PAGE_SIZE,
+                           current_user: schemas.UserSnapshot = Depends(get_current_user)):
+    templates = crud.get_premade_templates(db=db, cursor=cursor, limit=limit)
+    set_next_cursor(response, templates)
+    return templates
 
 
 class PastWriting(BaseModel):
@@ -523,21 +819,13 @@ class PastWriting(BaseModel):
 # might be unsecure
 @app.get("/responses/{goal_id}")
 @measure_time
-def view_responses(goal_id: int, response: Response, db: Session = Depends(get_db),
-                   current_user: models.User = Depends(get_current_user)):
-    verify_username_and_goal(username=current_user.username, goal_id=goal_id, db=db, response=response)
-    goal = crud.get_goal(db=db, goal_id=goal_id)
-    if not goal:
-        message = {"message": "error: goal not found"}
-        response.status_code = status.HTTP_404_NOT_FOUND
-        return message
-
+def view_responses(response: Response, db: Session = Depends(get_db), history: bool = False,
+                   goal: models.Goal = Depends(get_owned_goal)):
+    # the older check-ins are archived, history=true includes them
     writings = []
-    answers = crud.get_responses_by_goal(db=db, goal_id=goal_id)
-    for answer in answers:
-        question = crud.get_question(db=db, question_id=answer.question_id)
+    for answer in crud.get_responses_with_questions(db=db, goal_id=goal.id, history=history):
         writing = PastWriting(
-            question=question.text,
+            question=answer.question,
             answer=answer.text,
             check_in_number=answer.check_in_number
         )
@@ -545,36 +833,29 @@ def view_responses(goal_id: int, response: Response, db: Session = Depends(get_d
     return writings
 
 
-# might be unsecure
 @app.post("/create_response")
 @measure_time
-def create_response(resp: schemas.ResponseCreate, response: Response,
-                    db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
-    goal = crud.get_goal(db=db, goal_id=resp.goal_id)
+async def create_response(resp: schemas.ResponseCreate, request: Request, response: Response,
+                          db: AsyncSession = Depends(get_async_db),
+                          current_user: schemas.UserSnapshot = Depends(get_current_user)):
+    goal = await async_crud.get_goal(db=db, goal_id=resp.goal_id)
     if not goal:
-        message = {"message": "error: goal not found"}
-        response.status_code = status.HTTP_403_FORBIDDEN
-        return message
-    crud.create_response(db=db, response=resp)
+        raise exceptions.NonexistentGoalException
+    if goal.creator_id != current_user.id:
+        raise exceptions.ForbiddenGoalException
+    goal_id = goal.id
+    await write_async(request, db, lambda writer: crud.create_response(
+        db=writer, text=resp.text, question_id=resp.question_id,
+        check_in_number=resp.check_in_number, goal_id=goal_id).response_id)
     message = {"message": "response created!"}
     return message
 
 
 @app.put("/achieved_goal/{goal_id}")
 @measure_time
-def achieved_goal(goal_id: int, response: Response, db: Session = Depends(get_db),
-                  current_user: models.User = Depends(get_current_user)):
-    verify_username_and_goal(username=current_user.username, goal_id=goal_id, db=db, response=response)
-    goal = crud.get_goal(db=db, goal_id=goal_id)
-    if not goal:
-        message = {"message": "error: goal not found"}
-        response.status_code = status.HTTP_404_NOT_FOUND
-        return message
-    if goal.creator_id != current_user.id:
-        message = {"message": "not your goal"}
-        response.status_code = status.HTTP_403_FORBIDDEN
-        return message
-    if not crud.mark_goal_achieved(db=db, goal_id=goal_id):
+def achieved_goal(response: Response, db: Session = Depends(get_db),
+                  goal: models.Goal = Depends(get_owned_goal)):
+    if not crud.mark_goal_achieved(db=db, goal_id=goal.id):
         message = {"message": "some server error?!"}
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
         return message
@@ -599,19 +880,10 @@ def achieved_goal(goal_id: int, response: Response, db: Session = Depends(get_db
 
 @app.delete("/delete_goal/{goal_id}")
 @measure_time
-def delete_goal(goal_id: int, response: Response, db: Session = Depends(get_db),
-                current_user: models.User = Depends(get_current_user)):
-    verify_username_and_goal(username=current_user.username, goal_id=goal_id, db=db, response=response)
-    goal = crud.get_goal(db=db, goal_id=goal_id)
-    if not goal:
-        message = {"message": "error: goal not found"}
-        response.status_code = status.HTTP_404_NOT_FOUND
-        return message
-    if goal.creator_id != current_user.id:
-        message = {"message": "not your goal"}
-        response.status_code = status.HTTP_403_FORBIDDEN
-        return message
-    if not crud.delete_goal(db=db, goal_id=goal_id):
+def delete_goal(response: Response, db: Session = Depends(get_db),
+                goal: models.Goal = Depends(get_owned_goal)):
+    # the goal is hidden now and purged with its responses in the background
+    if not crud.soft_delete_goal(db=db, goal_id=goal.id):
         message = {"message": "goal not deleted"}
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
         return message
@@ -626,20 +898,10 @@ class CheckInPeriod(BaseModel):
 
 @app.put("/edit_check_in_period/{goal_id}")
 @measure_time
-def edit_check_in_period(goal_id: int, check_in_period: CheckInPeriod,
+def edit_check_in_period(check_in_period: CheckInPeriod,
                          response: Response, db: Session = Depends(get_db),
-                         current_user: models.User = Depends(get_current_user)):
-    verify_username_and_goal(username=current_user.username, goal_id=goal_id, db=db, response=response)
-    goal = crud.get_goal(db=db, goal_id=goal_id)
-    if not goal:
-        message = {"message": "error: goal not found"}
-        response.status_code = status.HTTP_404_NOT_FOUND
-        return message
-    if goal.creator_id != current_user.id:
-        message = {"message": "not your goal"}
-        response.status_code = status.HTTP_403_FORBIDDEN
-        return message
-    if not crud.update_goal_check_in_period(db=db, goal_id=goal_id, new_check_in=check_in_period.new_check_in):
+                         goal: models.Goal = Depends(get_owned_goal)):
+    if not crud.update_goal_check_in_period(db=db, goal_id=goal.id, new_check_in=check_in_period.new_check_in):
         message = {"message": "server error"}
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
         return message
@@ -651,7 +913,7 @@ def edit_check_in_period(goal_id: int, check_in_period: CheckInPeriod,
 @app.put("/update_database")
 @measure_time
 def update_database(response: Response, db: Session = Depends(get_db),
-                    current_user: models.User = Depends(get_current_user)):
+                    current_user: schemas.UserSnapshot = Depends(get_current_user)):
     crud.update_can_check_in(db=db)
     message = {"message": "database updated"}
     response.status_code = status.HTTP_200_OK
@@ -660,11 +922,8 @@ def update_database(response: Response, db: Session = Depends(get_db),
 
 @app.get("/list_check_in_questions/{goal_id}")
 @measure_time
-def list_check_in_questions(goal_id: int, response: Response, db: Session = Depends(get_db),
-                            current_user: models.User = Depends(get_current_user)):
-    verify_username_and_goal(username=current_user.username, goal_id=goal_id, db=db, response=response)
-    # error checking
-    goal = crud.get_goal(db=db, goal_id=goal_id)
+def list_check_in_questions(response: Response, db: Session = Depends(get_db),
+                            goal: models.Goal = Depends(get_owned_goal)):
     return crud.get_check_in_questions(db=db, this_check_in=goal.check_in_num + 1, this_template=goal.template_id)
 
 
@@ -674,10 +933,8 @@ class CheckInAnswers(BaseModel):
 
 @app.post("/check_in/{goal_id}")
 @measure_time
-def check_in(goal_id: int, check_in_answers: CheckInAnswers,
-             response: Response, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
-    verify_username_and_goal(username=current_user.username, goal_id=goal_id, db=db, response=response)
-    goal = crud.get_goal(db=db, goal_id=goal_id)
+def check_in(check_in_answers: CheckInAnswers, request: Request,
+             response: Response, db: Session = Depends(get_db), goal: models.Goal = Depends(get_owned_goal)):
     for answer in check_in_answers.answers:
         question = crud.get_question(db=db, question_id=answer.question_id)
         if not question:
@@ -685,9 +942,15 @@ def check_in(goal_id: int, check_in_answers: CheckInAnswers,
             response.status_code = status.HTTP_400_BAD_REQUEST
             return message
 
-        crud.create_response(db=db, text=answer.text, question_id=answer.question_id,
-                             check_in_number=goal.check_in_num + 1, goal_id=goal.id)
-    crud.after_check_in_update(goal_id=goal_id, db=db)
+    goal_id, check_in_number = goal.id, goal.check_in_num + 1
+
+    def record_check_in(writer: Session):
+        for answer in check_in_answers.answers:
+            crud.create_response(db=writer, text=answer.text, question_id=answer.question_id,
+                                 check_in_number=check_in_number, goal_id=goal_id)
+        crud.after_check_in_update(goal_id=goal_id, db=writer)
+
+    write(request, db, record_check_in)
     message = {"answers created successfully!"}
     response.status_code = status.HTTP_201_CREATED
     return message
@@ -695,19 +958,21 @@ def check_in(goal_id: int, check_in_answers: CheckInAnswers,
 
 @app.put("/togglepause/{goal_id}")
 @measure_time
-def togglepause(goal_id: int, response: Response, db: Session = Depends(get_db),
-                current_user: models.User = Depends(get_current_user)):
-    verify_username_and_goal(username=current_user.username, goal_id=goal_id, db=db, response=response)
-    crud.toggle_goal_paused(db=db, goal_id=goal_id)
+def togglepause(response: Response, db: Session = Depends(get_db),
+                goal: models.Goal = Depends(get_owned_goal)):
+    crud.toggle_goal_paused(db=db, goal_id=goal.id)
     message = {"message": "Pause Toggled!"}
     response.status_code = status.HTTP_200_OK
     return message
 
 
-@app.get("/achieved_goals")
+@app.get("/achieved_goals", response_model=list[schemas.GoalSummary])
 @measure_time
-def achieved_goals(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
-    return crud.get_achieved_goals(username=current_user.username, db=db)
+def achieved_goals(response: Response, db: Session = Depends(get_db), cursor: str | None = None,
+                   limit: int = DEFAULT_PAGE_SIZE, current_user: schemas.UserSnapshot = Depends(get_current_user)):
+    goals = crud.get_achieved_goals(user_id=current_user.id, db=db, cursor=cursor, limit=limit)
+    set_next_cursor(response, goals)
+    return goals
 
 
 class PostInfo(BaseModel):
@@ -718,7 +983,7 @@ class PostInfo(BaseModel):
 @app.post("/create_post")
 @measure_time
 def create_post(postjson: PostInfo, response: Response, db: Session = Depends(get_db),
-                current_user: models.User = Depends(get_current_user)):
+                current_user: schemas.UserSnapshot = Depends(get_current_user)):
     post = crud.create_post(db=db, title=postjson.title, content=postjson.content, post_author=current_user.id)
     message = {"message": "Post Created!",
                "post_id": post.post_id}
@@ -735,15 +1000,16 @@ class FeedPost(BaseModel):
 
 @app.get("/see_posts", response_model=list[FeedPost])
 @measure_time
-def get_posts(db: Session = Depends(get_db), skip: int = 0, limit: int = 100,
-              current_user: models.User = Depends(get_current_user)):
-    posts = crud.get_feed(db=db, skip=skip, limit=limit)
+async def get_posts(response: Response, db: AsyncSession = Depends(get_async_db), cursor: str | None = None,
+                    limit: int = DEFAULT_PAGE_SIZE, current_user: schemas.UserSnapshot = Depends(get_current_user)):
+    posts = await async_crud.get_feed(db=db, cursor=cursor, limit=limit)
+    set_next_cursor(response, posts)
     feed: list[FeedPost] = []
     for post in posts:
         feed.append(FeedPost(
             title=post.title,
             content=post.content,
-            poster=crud.get_user(db=db, user_id=post.post_author).username,
+            poster=post.poster.username,
             post_id=post.post_id
         ))
     return feed
@@ -755,11 +1021,9 @@ class EditPost(BaseModel):
 
 @app.put("/edit_post/{post_id}")
 @measure_time
-def edit_post(post_id: int, editjson: EditPost,
-              response: Response, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
-    verify_username_and_post(username=current_user.username, post_id=post_id,
-                             response=response, db=db)
-    result = crud.edit_post_content(db=db, post_id=post_id,
+def edit_post(editjson: EditPost,
+              response: Response, db: Session = Depends(get_db), post: models.Post = Depends(get_owned_post)):
+    result = crud.edit_post_content(db=db, post_id=post.post_id,
                                     newcontent=editjson.content)
     if result:
         message = {"Successfully Edited!"}
@@ -776,21 +1040,15 @@ class Commment(BaseModel):
 
 @app.post("/leave_comment/{post_id}")
 @measure_time
-def leave_comment(post_id: int, comment: Commment, response: Response, db: Session = Depends(get_db),
-                  current_user: models.User = Depends(get_current_user),
+def leave_comment(post_id: int, comment: Commment, request: Request, response: Response,
+                  db: Session = Depends(get_db),
+                  current_user: schemas.UserSnapshot = Depends(get_current_user),
                   skip_for_testing: bool = Depends(is_running_tests)):
     if not current_user:
         raise exceptions.NonexistentUserException
     post = crud.get_post_by_id(db=db, post_id=post_id)
     if not post:
         raise exceptions.NonexistentForumPostException
-    comment = crud.create_comment(db=db, content=comment.text, post_id=post_id, comment_author=current_user.id)
-
-    if not comment:
-        message = {"message": "Server error/ was not able to create the comment"}
-        response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
-        return message
-
     # get user by post.id
     user = crud.get_user(db=db, user_id=post.post_author)
 
@@ -804,15 +1062,21 @@ def leave_comment(post_id: int, comment: Commment, response: Response, db: Sessi
     else:
         # send the email verification
         if not sendNotification(email=user.email, user=user.username, commentuser=current_user.username,
-                                comment=comment.content, posttitle=post.title):
-            # delete the comment
-            crud.delete_comment(db, comment_id=comment.comment_id)
+                                comment=comment.text, posttitle=post.title):
+            # sent before the comment is written, so nothing is left to roll back
             message = {"message": "Server error/ was not able to send notification to the user"}
             response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
             return message
 
+    comment_id = write(request, db, lambda writer: crud.create_comment(
+        db=writer, content=comment.text, post_id=post_id, comment_author=current_user.id).comment_id)
+    if not comment_id:
+        message = {"message": "Server error/ was not able to create the comment"}
+        response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        return message
+
     message = {"message": "comment created!",
-               "comment_id": comment.comment_id}
+               "comment_id": comment_id}
     return message
 
 
@@ -827,18 +1091,19 @@ class comments_with_author(BaseModel):
 
 @app.get("/comments/{post_id}")
 @measure_time
-def see_comments(post_id: int, db: Session = Depends(get_db),
-                 current_user: models.User = Depends(get_current_user)):
+def see_comments(post_id: int, response: Response, db: Session = Depends(get_db), cursor: str | None = None,
+                 limit: int = DEFAULT_PAGE_SIZE, current_user: schemas.UserSnapshot = Depends(get_current_user)):
     real_comments = []
-    comments = crud.get_comments_by_post(db=db, post_id=post_id)
-    for i in range(len(comments)):
+    comments = crud.get_comments_with_authors(db=db, post_id=post_id, cursor=cursor, limit=limit)
+    set_next_cursor(response, comments)
+    for comment, author_username in comments:
         real_comments.append(comments_with_author(
-            comment_id=comments[i].comment_id,
-            content=comments[i].content,
-            timestamp=comments[i].timestamp,
-            post_id=comments[i].post_id,
-            comment_author=comments[i].comment_author,
-            author_username=crud.get_user(db=db, user_id=comments[i].comment_author).username
+            comment_id=comment.comment_id,
+            content=comment.content,
+            timestamp=comment.timestamp,
+            post_id=comment.post_id,
+            comment_author=comment.comment_author,
+            author_username=author_username
         ))
     return real_comments
 
@@ -851,7 +1116,7 @@ class Peers(BaseModel):
 @app.post("/send_friend_request/{username}")
 @measure_time
 def send_friend_request(username: str, response: Response, db: Session = Depends(get_db),
-                        current_user: models.User = Depends(get_current_user)):
+                        current_user: schemas.UserSnapshot = Depends(get_current_user)):
     user1 = current_user
     user2 = crud.get_user_by_username(db=db, username=username)
     if not user1 or not user2:
@@ -872,13 +1137,13 @@ def send_friend_request(username: str, response: Response, db: Session = Depends
 @app.get("/my_friend_requests")
 @measure_time
 def see_friend_requests(db: Session = Depends(get_db),
-                        current_user: models.User = Depends(get_current_user)):
+                        current_user: schemas.UserSnapshot = Depends(get_current_user)):
     return crud.get_friend_requests(db=db, user_id=current_user.id)
 
 
 @app.post("/accept_friend_request/{username}")
 def accept_friend_request(username: str, response: Response, db: Session = Depends(get_db),
-                          current_user: models.User = Depends(get_current_user)):
+                          current_user: schemas.UserSnapshot = Depends(get_current_user)):
     user1 = current_user
     user2 = crud.get_user_by_username(db=db, username=username)
     if not user1 or not user2:
@@ -896,7 +1161,7 @@ def accept_friend_request(username: str, response: Response, db: Session = Depen
 @app.post("/deny_friend_request/{username}")
 @measure_time
 def deny_friend_requesst(username: str, response: Response, db: Session = Depends(get_db),
-                         current_user: models.User = Depends(get_current_user)):
+                         current_user: schemas.UserSnapshot = Depends(get_current_user)):
     user1 = current_user
     user2 = crud.get_user_by_username(db=db, username=username)
     if not user1 or not user2:
@@ -914,21 +1179,26 @@ def deny_friend_requesst(username: str, response: Response, db: Session = Depend
 
 @app.get("/friends")
 @measure_time
-def my_friends(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
-    return crud.get_users_friends(db=db, user_id=current_user.id)
+def my_friends(response: Response, db: Session = Depends(get_db), cursor: str | None = None,
+               limit: int = DEFAULT_PAGE_SIZE, current_user: schemas.UserSnapshot = Depends(get_current_user)):
+    friends = crud.get_users_friends(db=db, user_id=current_user.id, cursor=cursor, limit=limit)
+    set_next_cursor(response, friends)
+    return friends
 
 
-@app.get("/public_goals/{user_id}")
-def public_goals(user_id: int, db: Session = Depends(get_db)):
-    return crud.get_public_goals(db=db, user_id=user_id)
+@app.get("/public_goals/{user_id}", response_model=list[schemas.GoalSummary])
+def public_goals(user_id: int, response: Response, db: Session = Depends(get_db), cursor: str | None = None,
+                 limit: int = DEFAULT_PAGE_SIZE):
+    goals = crud.get_public_goals(db=db, user_id=user_id, cursor=cursor, limit=limit)
+    set_next_cursor(response, goals)
+    return goals
 
 
 @app.put("/togglepublic/{goal_id}")
 @measure_time
-def togglepublic(goal_id: int, response: Response, db: Session = Depends(get_db),
-                 current_user: models.User = Depends(get_current_user)):
-    verify_username_and_goal(username=current_user.username, goal_id=goal_id, db=db, response=response)
-    return crud.toggle_public_private(db=db, goal_id=goal_id)
+def togglepublic(response: Response, db: Session = Depends(get_db),
+                 goal: models.Goal = Depends(get_owned_goal)):
+    return crud.toggle_public_private(db=db, goal_id=goal.id)
 
 
 # SETTINGS
@@ -939,7 +1209,7 @@ class NewEmail(BaseModel):
 
 @app.put("/change_email_address")
 def change_email_address(emailjson: NewEmail, db: Session = Depends(get_db),
-                         current_user: models.User = Depends(get_current_user)):
+                         current_user: schemas.UserSnapshot = Depends(get_current_user)):
     crud.update_email_address(user_id=current_user.id, email=emailjson.email, db=db)
     message = {"detail": "email updated"}
     return message
@@ -951,7 +1221,7 @@ class NewUsername(BaseModel):
 
 @app.put("/change_username")
 def change_username(json: NewUsername, db: Session = Depends(get_db),
-                    current_user: models.User = Depends(get_current_user)):
+                    current_user: schemas.UserSnapshot = Depends(get_current_user)):
     try:
         crud.update_username(user_id=current_user.id, username=json.username, db=db)
     except:
@@ -968,14 +1238,12 @@ class NewPassword(BaseModel):
 
 @app.put("/change_password")
 def change_password(pwjson: NewPassword, response: Response, db: Session = Depends(get_db),
-                    current_user: models.User = Depends(get_current_user)):
+                    current_user: schemas.UserSnapshot = Depends(get_current_user)):
     if not verify_password(pwjson.repw, current_user.pw_hash):
         raise exceptions.IncorrectPreviousPasswordException
-    salt = bcrypt.gensalt(12)
-    passhash = bcrypt.hashpw(pwjson.newpw.encode('utf-8'), salt)
-    salt = salt.decode('utf-8')
-    passhash = passhash.decode('utf-8')
-    crud.update_password(user_id=current_user.id, newhash=passhash, newsalt=salt, db=db)
+    passhash, salt, cost = password_engine.hash_password(pwjson.newpw)
+    crud.update_password(user_id=current_user.id, newhash=passhash, newsalt=salt, db=db, newcost=cost)
+    revoke_all_tokens(db, current_user.id)
     message = {"detail": "password updated"}
     return message
 
@@ -991,12 +1259,7 @@ class GoalNGroupInfo(BigGoal):
 
 @app.post("/create_specific_goal_and_group")
 def create_specific_goal_and_group(json: GoalNGroupInfo, response: Response, db: Session = Depends(get_db),
-                                   current_user: models.User = Depends(get_current_user)):
-    user = crud.get_user_by_username(db=db, username=current_user.username)
-    if not user:
-        message = {"message": "user does not exist"}
-        response.status_code = status.HTTP_400_BAD_REQUEST
-        return message
+                                   current_user: schemas.UserSnapshot = Depends(get_current_user)):
     template = crud.get_template(db=db, template_id=json.template_id)
     if not template:
         raise exceptions.NonexistentTemplateException
@@ -1004,7 +1267,7 @@ def create_specific_goal_and_group(json: GoalNGroupInfo, response: Response, db:
     goal = crud.create_goal(db=db, goal_name=json.goal_name,
                             check_in_period=json.check_in_period,
                             template_id=json.template_id,
-                            user_id=user.id,
+                            user_id=current_user.id,
                             is_group=json.is_group)
 
     for answer in json.responses:
@@ -1033,7 +1296,7 @@ class CustomGoalNGroupInfo(BigCustomGoal):
 
 @app.post("/create_custom_goal_and_group")
 def create_custom_goal_and_group(json: CustomGoalNGroupInfo, response: Response, db: Session = Depends(get_db),
-                                 current_user: models.User = Depends(get_current_user)):
+                                 current_user: schemas.UserSnapshot = Depends(get_current_user)):
     # print(goaljson.questions_answers)
     if not current_user:
         message = {"message": "user not found"}
@@ -1071,13 +1334,13 @@ def create_custom_goal_and_group(json: CustomGoalNGroupInfo, response: Response,
 @app.get("/my_friend_requests")
 @measure_time
 def see_friend_requests(db: Session = Depends(get_db),
-                        current_user: models.User = Depends(get_current_user)):
+                        current_user: schemas.UserSnapshot = Depends(get_current_user)):
     return crud.get_friend_requests(db=db, user_id=current_user.id)
 
 
 @app.post("/send_group_request/{group_id}")
 def send_group_request(group_id: int, db: Session = Depends(get_db),
-                       current_user: models.User = Depends(get_current_user)):
+                       current_user: schemas.UserSnapshot = Depends(get_current_user)):
     
     try:
         crud.create_group_invite(db=db, group_id=group_id, user_id=current_user.id)
@@ -1090,7 +1353,7 @@ def send_group_request(group_id: int, db: Session = Depends(get_db),
 
 @app.post("/accept_group_request/{group_id}")
 def accept_group_request(group_id: int, response: Response, db: Session = Depends(get_db),
-                         current_user: models.User = Depends(get_current_user)):
+                         current_user: schemas.UserSnapshot = Depends(get_current_user)):
     user = current_user
     group = crud.get_group(db=db, group_id=group_id)
     if not user or not group:
@@ -1109,7 +1372,7 @@ def accept_group_request(group_id: int, response: Response, db: Session = Depend
 @app.post("/deny_group_request/{group_id}")
 @measure_time
 def deny_group_request(group_id: int, response: Response, db: Session = Depends(get_db),
-                       current_user: models.User = Depends(get_current_user)):
+                       current_user: schemas.UserSnapshot = Depends(get_current_user)):
     user = current_user
     group = crud.get_group(db=db, group_id=group_id)
     if not user or not group:
@@ -1134,26 +1397,28 @@ class GroupResponse(BaseModel):
 
 @app.get("/my_group_invites", response_model=list[GroupResponse])
 def see_group_invites(db: Session = Depends(get_db),
-                      current_user: models.User = Depends(get_current_user)):
+                      current_user: schemas.UserSnapshot = Depends(get_current_user)):
     cheerios: list[GroupResponse] = []
     invites = crud.get_group_invites(db=db, user_id=current_user.id)
-    for i in range(len(invites)):
+    # creators and questions of all the invites in one query each
+    creator_names = crud.get_usernames(db=db, user_ids=list({invite.creator_id for invite in invites}))
+    questions = {}
+    for q in crud.get_questions_by_templates(db=db, template_ids=list({invite.template_id for invite in invites})):
+        questions.setdefault(q.template_id, []).append(SmallResponse(text=q.text, question_id=q.question_id))
+    for invite in invites:
         cheerios.append(GroupResponse(
-            group_name=invites[i].group_name,
-            group_id=invites[i].group_id,
-            template_id=invites[i].template_id,
-            questions=[],
-            creator_name=crud.get_user(db=db, user_id=invites[i].creator_id).username))
-        qs = crud.get_questions_by_template(db=db, template_id=invites[i].template_id)
-        for q in qs:
-            cheerios[i].questions.append(SmallResponse(text=q.text, question_id=q.question_id))
+            group_name=invite.group_name,
+            group_id=invite.group_id,
+            template_id=invite.template_id,
+            questions=questions.get(invite.template_id, []),
+            creator_name=creator_names[invite.creator_id]))
     return cheerios
 
 
 # todo: my groups
 @app.get("/my_groups")
 def view_my_groups(db: Session = Depends(get_db),
-                   current_user: models.User = Depends(get_current_user)):
+                   current_user: schemas.UserSnapshot = Depends(get_current_user)):
     return crud.get_user_groups(db=db, user_id=current_user.id)
 
 
@@ -1163,7 +1428,7 @@ class ResetPass(BaseModel):
     email: str
 
 
-@app.post("/reset_password")
+@app.post("/reset_password", dependencies=[Depends(rate_limit("reset_password"))])
 @measure_time
 def reset_password(reset: ResetPass, response: Response, db: Session = Depends(get_db)):
     # rigid email
@@ -1187,15 +1452,7 @@ def reset_password(reset: ResetPass, response: Response, db: Session = Depends(g
     # build jwt with type reset_pass
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     # sub has to be string
-    access_token = create_access_token(
-        data={"sub": str({
-            "user": user.username,
-            "id": user.id
-        }),
-            "typ": "pass_verification"
-        }
-        , expires_delta=access_token_expires
-    )
+    access_token = create_single_use_token(user, "pass_verification", access_token_expires)
     sent = resetpassVerification(email=user.email, user=user.username, token=access_token)
     # send email
     if not sent:
@@ -1227,9 +1484,6 @@ def verify_email(reset: ResetPassword, response: Response, db: Session = Depends
 
     try:
         payload = jwt.decode(token=reset.token, key=SECRET_KEY, algorithms=[ALGORITHM])
-        sub_payload: str = payload.get("sub")
-        # convert string back to dict to retrieve user and user_id
-        sub_payload: dict = eval(sub_payload)
         type_payload: str = payload.get("typ")
 
         if type_payload == None:
@@ -1242,8 +1496,18 @@ def verify_email(reset: ResetPassword, response: Response, db: Session = Depends
             response.status_code = status.HTTP_401_UNAUTHORIZED
             return message
 
-        user: str = sub_payload.get("user")
-        user_id: int = sub_payload.get("id")
+        claims = single_use_claims(reset.token, payload)
+        if claims is None:
+            message = {"message": "Bad credentials/sub"}
+            response.status_code = status.HTTP_401_UNAUTHORIZED
+            return message
+        user, user_id, jti = claims
+
+        # replays are rejected here, before the user lookup and the bcrypt hash
+        if redeemed_tokens.is_redeemed(jti):
+            message = {"message": "Bad credentials/token_already_used"}
+            response.status_code = status.HTTP_401_UNAUTHORIZED
+            return message
 
         db_user = crud.get_user(db, user_id)
 
@@ -1257,16 +1521,19 @@ def verify_email(reset: ResetPassword, response: Response, db: Session = Depends
             response.status_code = status.HTTP_401_UNAUTHORIZED
             return message
 
+        if not redeemed_tokens.redeem(db, jti, datetime.utcfromtimestamp(payload["exp"])):
+            message = {"message": "Bad credentials/token_already_used"}
+            response.status_code = status.HTTP_401_UNAUTHORIZED
+            return message
+
         # everything was good change the password
-        salt = bcrypt.gensalt(12)
-        passhash = bcrypt.hashpw(reset.password.encode('utf-8'), salt)
-        salt = salt.decode('utf-8')
-        passhash = passhash.decode('utf-8')
+        passhash, salt, cost = password_engine.hash_password(reset.password)
 
-        if not crud.update_password(user_id=db_user.id, newhash=passhash, newsalt=salt, db=db):
+        if not crud.update_password(user_id=db_user.id, newhash=passhash, newsalt=salt, db=db, newcost=cost):
             message = {"message": "Error updating verification"}
             response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
             return message
+        revoke_all_tokens(db, db_user.id)
 
         message = {"message": "Succesfully Updated Password/Please relogin"}
         response.status_code = status.HTTP_200_OK
@@ -1281,44 +1548,18 @@ def verify_email(reset: ResetPassword, response: Response, db: Session = Depends
 @app.delete("/delete_account/{user}")
 @measure_time
 def delete_account(user: str, response: Response, db: Session = Depends(get_db),
-                    current_user: models.User = Depends(get_current_user)):
+                    current_user: schemas.UserSnapshot = Depends(get_current_user)):
     # check if the passed user and current user are same
     if user != current_user.username:
         message = {"message": "You are not Authorized to delete the user"}
         response.status_code = status.HTTP_401_UNAUTHORIZED
         return message
-    
-    # get user id
-    db_user = crud.get_user_by_username(db, user)
-
-    if not db_user:
-        message = {"message": "Please try again, could not locate user"}
-        response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
-        return message
-
-    
-    # get all the current groups that the owner owns
-    curr_groups = crud.get_group_by_owner(db, db_user.id)
-
-    #iterate through the groups and transfer ownership
-    for group in curr_groups:
-        members = crud.get_group_members(db, group.group_id)
-        # if the user is the only member in the group delete the group
-        if len(members) == 1:
-            crud.delete_group(db, group.group_id)
-        # transfer ownership to the first person except the user that is returned.
-        else:
-            crud.update_group_owner(db, group.group_id, members[1].id)
-    
-        # go through all the goals of particular group_id and change the creator as above.
-
-        goals = crud.get_goal_by_group(db, group.group_id)
-
-        for goal in goals:
-            crud.update_goal_owner(db, goal.id, members[1].id)
 
-    # delete the user and all his history
-    crud.delete_user(db, db_user.id)  
+    # hide the user and everything they made, purge.py deletes it in the background;
+    # owned groups go to another member (with their goals), or are deleted when
+    # nobody else joined them
+    revoke_all_tokens(db, current_user.id)
+    crud.soft_delete_user(db, current_user.id)
     message = {"account deleted!"} 
     return message 
 
@@ -1332,7 +1573,7 @@ class TemplateBody(BaseModel):
 def create_template_4test(json: TemplateBody, db: Session=Depends(get_db), 
 
                           is_running_tests: bool = Depends(is_running_tests),
-                          current_user: models.User = Depends(get_current_user)):
+                          current_user: schemas.UserSnapshot = Depends(get_current_user)):
     if not is_running_tests:
         return
     template = crud.create_template(db=db, name=json.name, is_custom=False, creator_id=current_user.id)
@@ -0,0 +1,90 @@
+from sqlalchemy import inspect, text
+
+# create_all only creates missing tables, so columns added to existing tables
+# are brought in here. Every step must be safe to run again on every startup.
+
+# (table, column, column definition)
+ADDED_COLUMNS = [
+    ("users", "pw_cost", "INTEGER"),
+    ("users", "token_version", "INTEGER DEFAULT 0"),
+    ("users", "deleted_at", "DATETIME"),
+    ("posts", "deleted_at", "DATETIME"),
+    ("goals", "deleted_at", "DATETIME"),
+    ("purge_jobs", "attempts", "INTEGER DEFAULT 0"),
+    ("purge_jobs", "error", "VARCHAR"),
+]
+
+# indexes no query needs: the free-text ones are never filtered on but updated by
+# every insert, ix_posts_recent_comment and ix_users_unverified replace single
+# column indexes.
+# index name -> (table, column), kept so the benchmark can rebuild the old layout
+DROPPED_INDEXES = {
+    "ix_questions_text": ("questions", "text"),
+    "ix_responses_text": ("responses", "text"),
+    "ix_posts_title": ("posts", "title"),
+    "ix_posts_content": ("posts", "content"),
+    "ix_comments_content": ("comments", "content"),
+    "ix_posts_recent_comment_timestamp": ("posts", "recent_comment_timestamp"),
+    "ix_users_is_verified": ("users", "is_verified"),
+}
+
+
+def add_missing_columns(engine):
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    with engine.begin() as connection:
+        for table, column, definition in ADDED_COLUMNS:
+            if table not in tables:
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table)}
+            if column not in existing:
+                connection.execute(text('ALTER TABLE "{table}" ADD COLUMN {column} {definition}'
+                                        .format(table=table, column=column, definition=definition)))
+
+
+def fix_shared_template_creators(engine):
+    # shared templates used to be stored with creator_id -1, which has no user row
+    # and fails the foreign key check once SQLite enforces it
+    if "templates" not in inspect(engine).get_table_names():
+        return
+    with engine.begin() as connection:
+        connection.execute(text("UPDATE templates SET creator_id = NULL WHERE creator_id = -1"))
+
+
+def drop_unused_indexes(engine):
+    with engine.begin() as connection:
+        for name in DROPPED_INDEXES:
+            connection.execute(text('DROP INDEX IF EXISTS "{name}"'.format(name=name)))
+
+
+def rebuild_changed_indexes(engine, metadata):
+    # an index that gained columns keeps its old definition in existing databases
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {index["name"]: index["column_names"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing and existing[index.name] != [column.name for column in index.columns]:
+                with engine.begin() as connection:
+                    index.drop(bind=connection)
+                    index.create(bind=connection)
+
+
+def create_missing_indexes(engine, metadata):
+    # create_all skips tables that already exist, and with them their new indexes
+    tables = set(inspect(engine).get_table_names())
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+
+def run_migrations(engine, metadata):
+    add_missing_columns(engine)
+    fix_shared_template_creators(engine)
+    drop_unused_indexes(engine)
+    rebuild_changed_indexes(engine, metadata)
+    create_missing_indexes(engine, metadata)
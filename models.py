@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Date, Enum, DateTime
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Date, Enum, DateTime, Float, Index
 from sqlalchemy.orm import relationship
 import enum
 from database import Base
@@ -14,14 +14,71 @@ class User(Base):
     username = Column(String, unique=True, index=True)
     pw_hash = Column(String)
     pw_salt = Column(String)
+    pw_cost = Column(Integer, nullable=True)
+    token_version = Column(Integer, default=0)
     email = Column(String, unique=True, index=True)
-    is_verified = Column(Boolean, default=False, index=True)
+    is_verified = Column(Boolean, default=False)
     verification_sent_date = Column(Date)
+    # set by crud.soft_delete_user, the row is removed later by purge.py
+    deleted_at = Column(DateTime, nullable=True)
 
     goals = relationship("Goal", back_populates="creator")
     myposts = relationship("Post", back_populates="poster")
     #templates = relationsip("Template", back_populates="creator")
 
+    # crud.get_not_verified_user_ids reads the expired ones as a range
+    __table_args__ = (Index("ix_users_unverified", "is_verified", "verification_sent_date"),)
+
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True)
+    token_hash = Column(String, unique=True, index=True)
+    expires_at = Column(DateTime)
+    revoked = Column(Boolean, default=False)
+
+class TokenRevocation(Base):
+    __tablename__ = "token_revocations"
+
+    id = Column(Integer, primary_key=True, index=True)
+    # no foreign key, the row has to outlive a deleted user until expires_at
+    user_id = Column(Integer, index=True)
+    jti = Column(String, nullable=True)
+    token_version = Column(Integer, nullable=True)
+    expires_at = Column(DateTime, index=True)
+
+class RedeemedToken(Base):
+    __tablename__ = "redeemed_tokens"
+
+    id = Column(Integer, primary_key=True, index=True)
+    # unique so two workers cannot both redeem the same token
+    jti = Column(String, unique=True, index=True)
+    expires_at = Column(DateTime, index=True)
+
+class RateLimitBucket(Base):
+    __tablename__ = "rate_limit_buckets"
+
+    key = Column(String, primary_key=True)
+    tokens = Column(Float)
+    updated_at = Column(Float)
+
+class PurgeJob(Base):
+    __tablename__ = "purge_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    # "user" or "goal", and the id of the soft deleted row
+    kind = Column(String)
+    target_id = Column(Integer)
+    created_at = Column(DateTime)
+    # progress: the step of purge.py being worked on and the rows removed so far
+    step = Column(Integer, default=0)
+    rows_deleted = Column(Integer, default=0)
+    finished_at = Column(DateTime, nullable=True, index=True)
+    # failed runs and the last error, the job is given up after PURGE_MAX_ATTEMPTS
+    attempts = Column(Integer, default=0)
+    error = Column(String, nullable=True)
+
 class Friends(Base):
     __tablename__ = "friends"
 
@@ -29,6 +86,9 @@ class Friends(Base):
     user2 = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
     pending = Column(Boolean, default=True)
 
+    # friend lists and incoming requests look the user up as user2
+    __table_args__ = (Index("ix_friends_user2_pending", "user2", "pending", "user1"),)
+
 class Group(Base):
     __tablename__ = "groups"
 
@@ -49,7 +109,7 @@ class Goal(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     goal_name = Column(String, index=True)
-    creator_id = Column(Integer, ForeignKey("users.id"))
+    creator_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
     is_paused = Column(Boolean, default=False)
     start_date = Column(Date, index=True)   
     check_in_period = Column(Integer, index=True)
@@ -61,27 +121,39 @@ class Goal(Base):
     can_check_in = Column(Boolean, default=False)
     is_group_goal = Column(Boolean, default=False)
     group_id = Column(Integer, ForeignKey("groups.group_id", ondelete="CASCADE"), nullable=True)
+    deleted_at = Column(DateTime, nullable=True)
 
     creator = relationship("User", back_populates="goals")
     answers = relationship("Response", back_populates="goal", cascade="all, delete", passive_deletes=True)
 
+    # one index per crud.py filter; the creator_id ones also serve lookups by creator_id alone,
+    # and end in id for the pages of the goal lists (see pagination.py)
+    __table_args__ = (
+        Index("ix_goals_creator_achieved", "creator_id", "is_achieved", "id"),
+        Index("ix_goals_creator_public", "creator_id", "is_public", "id"),
+        Index("ix_goals_can_check_in", "can_check_in"),
+        Index("ix_goals_paused_next_check_in", "is_paused", "next_check_in"),
+    )
+
 class Template(Base):
     __tablename__ = "templates"
 
     template_id = Column(Integer, primary_key=True, index=True)
     is_custom = Column(Boolean, default=False)
     name = Column(String, index=True)
-    creator_id = Column(Integer, ForeignKey("users.id"), nullable=True)
+    creator_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"), nullable=True)
 
     #creator = relationship("User", back_populates="templates")
     questions = relationship("Question", back_populates="template")
 
+    __table_args__ = (Index("ix_templates_custom", "is_custom", "template_id"),)
+
 class Question(Base):
     __tablename__ = "questions"
 
     question_id = Column(Integer, primary_key=True, index=True)
-    text = Column(String, index=True)
-    template_id = Column(Integer, ForeignKey("templates.template_id"))
+    text = Column(String)
+    template_id = Column(Integer, ForeignKey("templates.template_id", ondelete="CASCADE"))
     response_type = Column(Enum(response_types), index=True)
     check_in_num = Column(Integer, index=True)
     next_check_in_period = Column(Integer, index=True)
@@ -89,36 +161,62 @@ class Question(Base):
     template = relationship("Template", back_populates="questions")
     #answers = relationship("Response", back_populates="question")
 
+    __table_args__ = (Index("ix_questions_template_check_in", "template_id", "check_in_num"),)
+
 class Response(Base):
     __tablename__ = "responses"
 
     response_id = Column(Integer, primary_key=True, index=True)
     question_id = Column(Integer, ForeignKey("questions.question_id"))
     goal_id = Column(Integer, ForeignKey("goals.id", ondelete="CASCADE"))
-    text = Column(String, index=True)
+    text = Column(String)
     check_in_number = Column(Integer, index=True)
 
     #question = relationship("Question", back_populates="answers")
     goal = relationship("Goal", back_populates="answers")
 
+    __table_args__ = (Index("ix_responses_goal_check_in", "goal_id", "check_in_number"),)
+
+# the responses of old check-ins and achieved goals, moved out of responses by
+# archive.py; only read when a goal's full history is asked for. id is the
+# archive's own key: SQLite may hand a moved response's id to a new response.
+class ArchivedResponse(Base):
+    __tablename__ = "responses_archive"
+
+    id = Column(Integer, primary_key=True, index=True)
+    response_id = Column(Integer)
+    question_id = Column(Integer, ForeignKey("questions.question_id"))
+    goal_id = Column(Integer, ForeignKey("goals.id", ondelete="CASCADE"))
+    text = Column(String)
+    check_in_number = Column(Integer)
+    archived_at = Column(DateTime)
+
+    __table_args__ = (Index("ix_responses_archive_goal", "goal_id", "response_id"),)
+
 class Post(Base):
     __tablename__ = "posts"
 
     post_id = Column(Integer, primary_key=True, index=True)
-    title = Column(String, index=True)
-    content = Column(String, index=True)
-    post_author = Column(Integer, ForeignKey("users.id"))
+    title = Column(String)
+    content = Column(String)
+    post_author = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
     timestamp = Column(DateTime, index=True)
-    recent_comment_timestamp = Column(DateTime, index=True, nullable=True)
+    recent_comment_timestamp = Column(DateTime, nullable=True)
+    deleted_at = Column(DateTime, nullable=True)
 
     poster = relationship("User", back_populates="myposts")
     comments = relationship("Comment", backref="posts", cascade = "all, delete-orphan", passive_deletes=True)
 
+    # the feed's page order
+    __table_args__ = (Index("ix_posts_recent_comment", "recent_comment_timestamp", "post_id"),)
+
 class Comment(Base):
     __tablename__ = "comments"
 
     comment_id = Column(Integer, primary_key=True, index=True)
-    content = Column(String, index=True)
+    content = Column(String)
     timestamp = Column(DateTime, index=True)
     post_id = Column(Integer, ForeignKey("posts.post_id", ondelete="CASCADE"))
-    comment_author = Column(Integer, ForeignKey("users.id"))
\ No newline at end of file
+    comment_author = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
+
+    __table_args__ = (Index("ix_comments_post_timestamp", "post_id", "timestamp", "comment_id"),)
\ No newline at end of file
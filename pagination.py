@@ -0,0 +1,92 @@
+import base64
+import binascii
+import json
+from datetime import date, datetime
+
+from fastapi import Response
+from sqlalchemy import tuple_
+
+import exceptions
+
+# Keyset pagination for the list endpoints. A page is read in a fixed order of
+# (sort key, id) columns backed by an index, starting after the last row of the
+# previous page:
+#   WHERE (sort_key, id) > (:last_sort_key, :last_id) ORDER BY sort_key, id LIMIT n + 1
+# so a deep page costs the same as the first one, unlike OFFSET. The position is
+# handed to the client as an opaque cursor in the X-Next-Cursor header (the
+# response bodies keep their shape); there is no header on the last page.
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+class Page(list):
+    """rows of one page, next_cursor is None on the last page"""
+
+    def __init__(self, rows, next_cursor: str | None = None):
+        super().__init__(rows)
+        self.next_cursor = next_cursor
+
+
+def page_size(limit: int | None):
+    return None if limit is None else max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def encode_cursor(values: list):
+    values = [value.isoformat() if isinstance(value, (date, datetime)) else value for value in values]
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, columns: list):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, binascii.Error):
+        raise exceptions.InvalidCursorException
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise exceptions.InvalidCursorException
+    decoded = []
+    for column, value in zip(columns, values):
+        python_type = column.type.python_type
+        try:
+            if python_type in (date, datetime):
+                value = python_type.fromisoformat(value)
+            elif type(value) is not python_type:
+                raise TypeError
+        except (TypeError, ValueError):
+            raise exceptions.InvalidCursorException
+        decoded.append(value)
+    return decoded
+
+
+def paginate(query, columns: list, cursor: str | None, limit: int | None, descending: bool = False):
+    """narrows a Query or select() to the page after cursor, plus one row to tell if another page follows"""
+    if cursor is not None:
+        after = decode_cursor(cursor, columns)
+        if len(columns) == 1:
+            keys, after = columns[0], after[0]
+        else:
+            keys, after = tuple_(*columns), tuple_(*after)
+        query = query.filter(keys < after if descending else keys > after)
+    query = query.order_by(*[column.desc() if descending else column for column in columns])
+    if limit is not None:
+        query = query.limit(page_size(limit) + 1)
+    return query
+
+
+def page(rows: list, columns: list, limit: int | None, key=None):
+    """the rows paginate() read as a Page; key(row) gives the row's values of columns"""
+    limit = page_size(limit)
+    if limit is None or len(rows) <= limit:
+        return Page(rows)
+    rows = rows[:limit]
+    if key is None:
+        values = [getattr(rows[-1], column.key) for column in columns]
+    else:
+        values = key(rows[-1])
+    return Page(rows, encode_cursor(values))
+
+
+def set_next_cursor(response: Response, rows: Page):
+    if rows.next_cursor is not None:
+        response.headers["X-Next-Cursor"] = rows.next_cursor
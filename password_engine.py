@@ -0,0 +1,117 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+import exceptions
+
+# bcrypt is deliberately slow, so hashing and checking passwords runs in a small
+# process pool instead of on the request threads. The number of jobs waiting on
+# the pool is capped: once it is full new requests get a 503 right away instead
+# of piling up and starving the threadpool that serves every other endpoint.
+
+PASSWORD_ENGINE_WORKERS = int(os.getenv("PASSWORD_ENGINE_WORKERS", os.cpu_count() or 1))
+PASSWORD_ENGINE_MAX_PENDING = int(os.getenv("PASSWORD_ENGINE_MAX_PENDING", 16))
+
+# the bcrypt cost is picked at startup as the highest cost whose hash fits in
+# BCRYPT_TARGET_MS on this machine, clamped to [BCRYPT_MIN_COST, BCRYPT_MAX_COST].
+# BCRYPT_COST pins it instead (the tests use this to run at the minimum cost).
+BCRYPT_COST = int(os.environ["BCRYPT_COST"]) if os.getenv("BCRYPT_COST") else None
+BCRYPT_TARGET_MS = float(os.getenv("BCRYPT_TARGET_MS", 250))
+BCRYPT_MIN_COST = 10
+BCRYPT_MAX_COST = 16
+# cost of every hash written before the cost was stored next to it
+LEGACY_BCRYPT_COST = 12
+
+
+def _hash_password(password: str, rounds: int):
+    salt = bcrypt.gensalt(rounds)
+    passhash = bcrypt.hashpw(password.encode('utf-8'), salt)
+    return passhash.decode('utf-8'), salt.decode('utf-8')
+
+
+def calibrate_cost(target_ms: float = BCRYPT_TARGET_MS):
+    # every extra round doubles the work, so time one cheap hash and extrapolate
+    probe_cost = 8
+    start = time.perf_counter()
+    _hash_password("calibration", probe_cost)
+    probe_ms = (time.perf_counter() - start) * 1000
+    cost = probe_cost
+    while cost < BCRYPT_MAX_COST and probe_ms * 2 ** (cost + 1 - probe_cost) <= target_ms:
+        cost += 1
+    return max(BCRYPT_MIN_COST, cost)
+
+
+def stored_cost(pw_hash: str, pw_cost: int | None):
+    if pw_cost is not None:
+        return pw_cost
+    # "$2b$12$..." -> 12
+    try:
+        return int(pw_hash.split("$")[2])
+    except (IndexError, ValueError):
+        return LEGACY_BCRYPT_COST
+
+
+def _verify_password(password: str, hashed_password: str):
+    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+
+class PasswordEngine:
+    def __init__(self, workers: int = PASSWORD_ENGINE_WORKERS,
+                 max_pending: int = PASSWORD_ENGINE_MAX_PENDING, cost: int | None = BCRYPT_COST):
+        # workers == 0 runs bcrypt inline on the calling thread (still bounded)
+        self.workers = workers
+        self.cost = cost
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self.rejected = 0
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                # spawn so the workers do not inherit the server's threads and sockets
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise exceptions.PasswordEngineBusyException
+        try:
+            if self.workers == 0:
+                return func(*args)
+            return self._get_pool().submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def target_cost(self):
+        if self.cost is None:
+            self.cost = calibrate_cost()
+        return self.cost
+
+    def hash_password(self, password: str):
+        """returns (pw_hash, pw_salt, pw_cost) hashed at the target cost"""
+        cost = self.target_cost()
+        passhash, salt = self._run(_hash_password, password, cost)
+        return passhash, salt, cost
+
+    def needs_rehash(self, pw_hash: str, pw_cost: int | None):
+        return stored_cost(pw_hash, pw_cost) != self.target_cost()
+
+    def verify_password(self, password: str, hashed_password: str):
+        return self._run(_verify_password, password, hashed_password)
+
+    def shutdown(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+                self._pool = None
+
+
+password_engine = PasswordEngine()
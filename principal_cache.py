@@ -0,0 +1,97 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+# bounded TTL/LRU cache of authenticated users, keyed by a digest of the bearer token
+# so get_current_user does not need a database round trip on every request
+
+PRINCIPAL_CACHE_MAX_ENTRIES = 1024
+PRINCIPAL_CACHE_TTL_SECONDS = 60
+
+
+def token_digest(token: str):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+class PrincipalCache:
+    def __init__(self, max_entries: int = PRINCIPAL_CACHE_MAX_ENTRIES,
+                 ttl_seconds: float = PRINCIPAL_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # digest -> (expires_at, snapshot, claims), oldest first
+        self._entries = OrderedDict()
+        # user_id -> digests of the tokens cached for that user
+        self._by_user = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str):
+        """returns (snapshot, claims) for a cached token, otherwise None"""
+        digest = token_digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, snapshot, claims = entry
+            if expires_at <= time.time():
+                self._remove(digest)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return snapshot, claims
+
+    def put(self, token: str, snapshot, claims: dict):
+        digest = token_digest(token)
+        expires_at = time.time() + self.ttl_seconds
+        # never serve a principal past the expiry of the token it came from
+        if claims.get("exp") is not None:
+            expires_at = min(expires_at, claims["exp"])
+        with self._lock:
+            if digest in self._entries:
+                self._remove(digest)
+            self._entries[digest] = (expires_at, snapshot, claims)
+            self._by_user.setdefault(snapshot.id, set()).add(digest)
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            for digest in self._by_user.pop(user_id, set()):
+                self._entries.pop(digest, None)
+
+    def invalidate_token(self, token: str):
+        with self._lock:
+            digest = token_digest(token)
+            if digest in self._entries:
+                self._remove(digest)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "size": len(self._entries),
+                    "max_entries": self.max_entries}
+
+    def _remove(self, digest: str):
+        # caller must hold the lock
+        _, snapshot, _ = self._entries.pop(digest)
+        digests = self._by_user.get(snapshot.id)
+        if digests is not None:
+            digests.discard(digest)
+            if not digests:
+                del self._by_user[snapshot.id]
+
+
+principal_cache = PrincipalCache()
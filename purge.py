@@ -0,0 +1,125 @@
+import logging
+import os
+import time
+from datetime import datetime
+
+import crud
+from database import SessionLocal
+
+# Removes soft deleted accounts and goals (crud.soft_delete_user and
+# crud.soft_delete_goal) in the background, run by the scheduler. Every deletion
+# has a PurgeJob row; its rows go step by step, children first (see
+# crud.user_deletion_steps), at most PURGE_BATCH_SIZE rows per transaction, with
+# a pause of PURGE_PAUSE_SECONDS after each so the write lock is not held away
+# from the requests for long. The job's step and rows_deleted are saved with
+# every batch, a purge that was stopped carries on where it was. A job that
+# fails is logged, its attempts and error are saved, and the next job runs; it
+# is retried on the next run, after the others, up to PURGE_MAX_ATTEMPTS times.
+# purge_unverified_users deletes the accounts never verified the same way, a
+# transaction per PURGE_BATCH_SIZE users.
+#   PURGE_BATCH_SIZE     rows deleted per transaction
+#   PURGE_PAUSE_SECONDS  pause between two transactions
+#   PURGE_MAX_ATTEMPTS   failed runs after which a job is left alone
+
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", 500))
+PURGE_PAUSE_SECONDS = float(os.getenv("PURGE_PAUSE_SECONDS", 0.05))
+PURGE_MAX_ATTEMPTS = int(os.getenv("PURGE_MAX_ATTEMPTS", 5))
+
+purge_log = logging.getLogger("purge")
+
+# kind -> (the rows hanging off the deleted one, the crud function deleting what is left)
+PURGES = {
+    "user": (lambda user_id: crud.user_deletion_steps([user_id]), crud.delete_user),
+    "goal": (crud.goal_deletion_steps, crud.delete_goal),
+}
+
+
+class Purger:
+    def __init__(self, session_factory=SessionLocal, batch_size: int = PURGE_BATCH_SIZE,
+                 pause_seconds: float = PURGE_PAUSE_SECONDS, max_attempts: int = PURGE_MAX_ATTEMPTS):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.pause_seconds = pause_seconds
+        self.max_attempts = max_attempts
+
+    def run_batch(self, db, job):
+        """one bounded step of the job, True once it is finished"""
+        steps, finish = PURGES[job.kind]
+        steps = steps(job.target_id)
+        if job.step < len(steps):
+            model, condition = steps[job.step]
+            deleted = crud.delete_rows(db, model, condition, limit=self.batch_size)
+            job.rows_deleted += deleted
+            if deleted < self.batch_size:
+                job.step += 1
+            return False
+        # only the row itself is left
+        finish(db, job.target_id)
+        job.rows_deleted += 1
+        job.finished_at = datetime.utcnow()
+        return True
+
+    def run_job(self, job_id: int):
+        finished = False
+        while not finished:
+            db = self.session_factory()
+            try:
+                job = crud.get_purge_job(db, job_id)
+                if job is None or job.finished_at is not None:
+                    return
+                finished = self.run_batch(db, job)
+                db.commit()
+                if finished:
+                    purge_log.info("purged %s %d, %d rows", job.kind, job.target_id, job.rows_deleted)
+            finally:
+                db.close()
+            if not finished and self.pause_seconds:
+                time.sleep(self.pause_seconds)
+
+    def run_pending(self):
+        db = self.session_factory()
+        try:
+            job_ids = [job.id for job in crud.get_pending_purge_jobs(db, self.max_attempts)]
+        finally:
+            db.close()
+        for job_id in job_ids:
+            try:
+                self.run_job(job_id)
+            except Exception as e:
+                purge_log.exception("purge job %d failed", job_id)
+                self.record_failure(job_id, e)
+        return len(job_ids)
+
+    def record_failure(self, job_id: int, error: Exception):
+        db = self.session_factory()
+        try:
+            crud.record_purge_failure(db, job_id, "{name}: {error}".format(name=type(error).__name__, error=error))
+            db.commit()
+        finally:
+            db.close()
+
+
+def purge_unverified_users(session_factory=SessionLocal, batch_size: int = PURGE_BATCH_SIZE,
+                           pause_seconds: float = PURGE_PAUSE_SECONDS):
+    """deletes the users who did not verify their email in time, batch_size per transaction"""
+    deleted, after_id = 0, 0
+    while True:
+        db = session_factory()
+        try:
+            user_ids = crud.get_not_verified_user_ids(db, after_id, batch_size)
+            if user_ids:
+                deleted += crud.delete_users(db, user_ids)
+                db.commit()
+        finally:
+            db.close()
+        if len(user_ids) < batch_size:
+            break
+        after_id = user_ids[-1]
+        if pause_seconds:
+            time.sleep(pause_seconds)
+    if deleted:
+        purge_log.info("deleted %d unverified users", deleted)
+    return deleted
+
+
+purger = Purger()
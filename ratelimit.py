@@ -0,0 +1,195 @@
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+from fastapi import Request
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import case, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+import exceptions
+import models
+
+# Token-bucket limits for the endpoints that do expensive work (bcrypt, SMTP).
+# Each request takes one token from a bucket per client IP and one per username;
+# buckets refill continuously at `rate` tokens per second up to `burst`.
+# The check runs as a route dependency, so a rejected request gets its 429
+# before the handler hashes anything or touches the database.
+#
+# RATE_LIMIT_BACKEND=memory (default) keeps buckets per process,
+# RATE_LIMIT_BACKEND=database keeps them in the rate_limit_buckets table so
+# every worker pointing at the same database shares them.
+#
+# Behind a proxy (the Heroku router, see Procfile) request.client is the proxy.
+# Every proxy appends the address it got the request from to X-Forwarded-For, so
+# with RATE_LIMIT_PROXY_HOPS=n trusted proxies in front the client is the n-th
+# address from the right; the ones left of it are whatever the client sent.
+
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_PROXY_HOPS = int(os.getenv("RATE_LIMIT_PROXY_HOPS", 0))
+
+
+@dataclass(frozen=True)
+class Limit:
+    rate: float  # tokens per second
+    burst: int
+
+
+# scope -> (limit per client ip, limit per username)
+RATE_LIMITS = {
+    "token": (Limit(rate=30 / 60, burst=10), Limit(rate=10 / 60, burst=5)),
+    "signup": (Limit(rate=5 / 60, burst=5), None),
+    "reset_password": (Limit(rate=5 / 60, burst=3), Limit(rate=3 / 3600, burst=3)),
+}
+
+
+class MemoryBucketStore:
+    blocking = False
+    # seconds between sweeps for buckets that have refilled
+    sweep_interval = 60
+
+    def __init__(self):
+        self._buckets = {}  # key -> (tokens, updated_at, full_at)
+        self._lock = threading.Lock()
+        self._next_sweep = 0.0
+
+    def take(self, key: str, limit: Limit, now: float):
+        """takes a token, returns 0 if allowed or the seconds until one is available"""
+        with self._lock:
+            self._sweep(now)
+            tokens, updated_at, _ = self._buckets.get(key, (limit.burst, now, now))
+            tokens = min(limit.burst, tokens + (now - updated_at) * limit.rate)
+            retry_after = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / limit.rate
+            self._buckets[key] = (tokens, now, now + (limit.burst - tokens) / limit.rate)
+            return retry_after
+
+    def _sweep(self, now: float):
+        # a full bucket is the same as none, so every IP and username seen does
+        # not stay in memory for the life of the process
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.sweep_interval
+        for key in [key for key, (_, _, full_at) in self._buckets.items() if full_at <= now]:
+            del self._buckets[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._buckets)
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+            self._next_sweep = 0.0
+
+
+class DatabaseBucketStore:
+    # takes a round trip to the database, so it is kept off the event loop
+    blocking = True
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.table = models.RateLimitBucket.__table__
+
+    def take(self, key: str, limit: Limit, now: float):
+        table = self.table
+        grown = table.c.tokens + (now - table.c.updated_at) * limit.rate
+        refilled = case((grown > limit.burst, limit.burst), else_=grown)
+        with self.engine.begin() as connection:
+            # refill and take in one conditional UPDATE so concurrent workers cannot
+            # both spend the same token
+            taken = connection.execute(
+                update(table).where(table.c.key == key).where(refilled >= 1)
+                .values(tokens=refilled - 1, updated_at=now)
+            ).rowcount
+            if taken:
+                return 0
+            tokens = connection.execute(select(refilled).where(table.c.key == key)).scalar()
+        if tokens is None:
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(insert(table).values(key=key, tokens=limit.burst - 1, updated_at=now))
+                return 0
+            except IntegrityError:
+                # another worker created the bucket first
+                return self.take(key, limit, now)
+        return (1 - tokens) / limit.rate
+
+    def reset(self):
+        with self.engine.begin() as connection:
+            connection.execute(self.table.delete())
+
+
+class RateLimiter:
+    def __init__(self, store, limits: dict = RATE_LIMITS):
+        self.store = store
+        self.limits = limits
+        self.rejected = 0
+
+    def check(self, scope: str, client_ip: str | None, username: str | None):
+        ip_limit, username_limit = self.limits[scope]
+        now = time.time()
+        retry_after = 0
+        if ip_limit is not None and client_ip:
+            retry_after = self.store.take("{scope}:ip:{ip}".format(scope=scope, ip=client_ip), ip_limit, now)
+        # only requests the IP limit let through count against the username, a
+        # throttled client cannot drain someone else's bucket and lock them out
+        if username_limit is not None and username and not retry_after:
+            retry_after = self.store.take("{scope}:user:{name}".format(scope=scope, name=username),
+                                          username_limit, now)
+        if retry_after:
+            self.rejected += 1
+            raise exceptions.TooManyRequestsException(retry_after=int(retry_after) + 1)
+
+    def reset(self):
+        self.store.reset()
+        self.rejected = 0
+
+
+def make_store(backend: str = RATE_LIMIT_BACKEND):
+    if backend == "database":
+        from database import engine
+        return DatabaseBucketStore(engine)
+    return MemoryBucketStore()
+
+
+limiter = RateLimiter(make_store())
+
+
+def client_ip(request: Request):
+    if RATE_LIMIT_PROXY_HOPS:
+        forwarded = [ip.strip() for ip in request.headers.get("x-forwarded-for", "").split(",") if ip.strip()]
+        if len(forwarded) >= RATE_LIMIT_PROXY_HOPS:
+            return forwarded[-RATE_LIMIT_PROXY_HOPS]
+    return request.client.host if request.client else None
+
+
+async def _request_username(request: Request):
+    # FastAPI has already read and cached the body by the time dependencies run
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith(("application/x-www-form-urlencoded", "multipart/form-data")):
+        return (await request.form()).get("username")
+    if content_type.startswith("application/json"):
+        try:
+            body = await request.json()
+        except ValueError:
+            return None
+        if isinstance(body, dict):
+            return body.get("username")
+    return None
+
+
+def rate_limit(scope: str):
+    async def check_rate_limit(request: Request):
+        ip = client_ip(request)
+        username = await _request_username(request)
+        if limiter.store.blocking:
+            await run_in_threadpool(limiter.check, scope, ip, username)
+        else:
+            limiter.check(scope, ip, username)
+
+    return check_rate_limit
@@ -0,0 +1,62 @@
+import threading
+from datetime import datetime
+
+from sqlalchemy.orm import Session
+
+import crud
+from database import call_after_commit
+
+# Email verification and password reset tokens are single use. Redeeming one
+# records its jti in the redeemed_tokens table (unique, so only one worker can
+# win) and in memory, so a replay to this worker is turned away with a dict
+# lookup before any database work or bcrypt. Entries are kept until the token
+# itself expires; after that the signature check rejects it anyway.
+
+
+class RedeemedTokenStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # jti -> expires_at
+        self._redeemed = {}
+
+    def is_redeemed(self, jti: str):
+        with self._lock:
+            expires_at = self._redeemed.get(jti)
+            if expires_at is None:
+                return False
+            if expires_at <= datetime.utcnow():
+                del self._redeemed[jti]
+                return False
+            return True
+
+    def redeem(self, db: Session, jti: str, expires_at: datetime):
+        """marks the token as used, returns False if it already was"""
+        if self.is_redeemed(jti):
+            return False
+        # the database decides between workers; a replay another worker saw first
+        # fails the insert and is remembered here from then on
+        redeemed = crud.create_redeemed_token(db, jti=jti, expires_at=expires_at)
+        if redeemed:
+            # a request that fails after this rolls the insert back, the token stays usable
+            call_after_commit(db, lambda: self._remember(jti, expires_at))
+        else:
+            self._remember(jti, expires_at)
+        return redeemed
+
+    def _remember(self, jti: str, expires_at: datetime):
+        with self._lock:
+            self._redeemed[jti] = expires_at
+            if len(self._redeemed) % 1024 == 0:
+                self._prune()
+
+    def _prune(self):
+        # caller must hold the lock
+        now = datetime.utcnow()
+        self._redeemed = {jti: exp for jti, exp in self._redeemed.items() if exp > now}
+
+    def reset(self):
+        with self._lock:
+            self._redeemed.clear()
+
+
+redeemed_tokens = RedeemedTokenStore()
@@ -0,0 +1,122 @@
+import threading
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+import async_crud
+import crud
+from database import call_after_commit
+
+# In-memory view of the token_revocations table so get_current_user can reject
+# revoked access tokens without a query per request. Two kinds of rows:
+#   jti set           -> that one access token is revoked (logout)
+#   token_version set -> every token of the user older than that version is revoked
+# Rows are append-only, so other workers pick up new ones by reading past the
+# highest id they have seen, at most every REVOCATION_SYNC_SECONDS.
+
+REVOCATION_SYNC_SECONDS = 5
+
+
+class RevocationIndex:
+    def __init__(self, sync_seconds: float = REVOCATION_SYNC_SECONDS):
+        self.sync_seconds = sync_seconds
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # jti -> expires_at
+            self._revoked_jtis = {}
+            # user_id -> (lowest valid token_version, expires_at)
+            self._min_versions = {}
+            self._last_id = 0
+            self._last_sync = None
+
+    def _apply(self, row, advance: bool = True):
+        # caller must hold the lock. Rows written by this worker are applied right
+        # away without advancing the watermark, so older rows from other workers
+        # are still picked up by the next sync.
+        if row.jti is not None:
+            self._revoked_jtis[row.jti] = row.expires_at
+        if row.token_version is not None:
+            current = self._min_versions.get(row.user_id)
+            if current is None or current[0] < row.token_version:
+                self._min_versions[row.user_id] = (row.token_version, row.expires_at)
+        if advance:
+            self._last_id = max(self._last_id, row.id)
+
+    def _prune(self):
+        # caller must hold the lock; tokens past their expiry are rejected anyway
+        now = datetime.utcnow()
+        self._revoked_jtis = {jti: exp for jti, exp in self._revoked_jtis.items() if exp > now}
+        self._min_versions = {user_id: entry for user_id, entry in self._min_versions.items()
+                              if entry[1] > now}
+
+    def _sync_due(self, force: bool):
+        with self._lock:
+            return force or self._last_sync is None \
+                or time.monotonic() - self._last_sync >= self.sync_seconds
+
+    def _apply_synced(self, rows):
+        # the rows are read without holding the lock (the async path awaits the
+        # query), applying them twice is harmless
+        with self._lock:
+            for row in rows:
+                self._apply(row)
+            self._prune()
+            self._last_sync = time.monotonic()
+
+    def sync(self, db: Session, force: bool = False):
+        if self._sync_due(force):
+            self._apply_synced(crud.get_token_revocations_after(db, self._last_id))
+
+    async def sync_async(self, db: AsyncSession, force: bool = False):
+        if self._sync_due(force):
+            self._apply_synced(await async_crud.get_token_revocations_after(db, self._last_id))
+
+    def _is_revoked(self, user_id: int, jti: str | None, token_version: int):
+        with self._lock:
+            if jti is not None and jti in self._revoked_jtis:
+                return True
+            entry = self._min_versions.get(user_id)
+            return entry is not None and entry[0] > token_version
+
+    def is_revoked(self, db: Session, user_id: int, jti: str | None, token_version: int):
+        self.sync(db)
+        return self._is_revoked(user_id, jti, token_version)
+
+    async def is_revoked_async(self, db: AsyncSession, user_id: int, jti: str | None, token_version: int):
+        await self.sync_async(db)
+        return self._is_revoked(user_id, jti, token_version)
+
+    def _apply_after_commit(self, db: Session, row):
+        # a revocation that is rolled back must not stay in memory: a bumped
+        # token_version the database does not have would reject every new token
+        row = SimpleNamespace(id=row.id, user_id=row.user_id, jti=row.jti, token_version=row.token_version,
+                              expires_at=row.expires_at)
+
+        def apply():
+            with self._lock:
+                self._apply(row, advance=False)
+
+        call_after_commit(db, apply)
+
+    def revoke_token(self, db: Session, user_id: int, jti: str, expires_at: datetime):
+        row = crud.create_token_revocation(db, user_id=user_id, jti=jti, token_version=None,
+                                           expires_at=expires_at)
+        self._apply_after_commit(db, row)
+
+    def revoke_user(self, db: Session, user_id: int, expires_at: datetime):
+        """revoke every token issued to the user so far (expires_at: latest expiry of those tokens)"""
+        token_version = crud.bump_token_version(db, user_id)
+        if token_version is None:
+            return
+        row = crud.create_token_revocation(db, user_id=user_id, jti=None, token_version=token_version,
+                                           expires_at=expires_at)
+        self._apply_after_commit(db, row)
+
+
+revocation_index = RevocationIndex()
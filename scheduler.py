@@ -1,8 +1,11 @@
 
 from apscheduler.schedulers.blocking import BlockingScheduler
 from email_sender import sendCheckin
-from crud import update_can_check_in, delete_not_verified_users
-from database import get_database
+from crud import update_can_check_in, delete_expired_token_revocations, \
+    delete_expired_redeemed_tokens, delete_expired_refresh_tokens
+from database import session_scope
+from purge import purger, purge_unverified_users
+from archive import archive_responses
 from datetime import datetime
 
 # intialize scheduler
@@ -16,13 +19,21 @@ Run this as soon as the day changes at 00:01 am
 @sched.scheduled_job('cron', day_of_week='mon-sun', hour=0, minute=1)
 def daily_db_update():
     # the function updates can check_in for users that have there checkin today 
-    update_can_check_in(next(get_database()))
+    with session_scope() as db:
+        update_can_check_in(db)
     with open("update_checkin.log", "a") as f:
         f.write(f"Actual Database update for checkin happened at: {datetime.now()} Successfully!\n")
     # function gets the user that are not verified and deletes them from the table if they are not verified after 5 days
-    delete_not_verified_users(next(get_database()))
+    purge_unverified_users()
     with open("delete_users.log", "a") as f:
         f.write(f"Actual Not Verified Users Deleted at: {datetime.now()} Successfully!\n")
+    # revocations are only needed until the tokens they cover expire
+    with session_scope() as db:
+        delete_expired_token_revocations(db)
+    with session_scope() as db:
+        delete_expired_redeemed_tokens(db)
+    with session_scope() as db:
+        delete_expired_refresh_tokens(db)
 
 '''
 Run this at specific time everyday 10:00 am
@@ -45,14 +56,26 @@ def daily_checkin_email():
 @sched.scheduled_job('interval', seconds=300)
 def daily_db_update():
     # the function updates can check_in for users that have there checkin today 
-    update_can_check_in(next(get_database()))
+    with session_scope() as db:
+        update_can_check_in(db)
     with open("update_checkin.log", "a") as f:
         f.write(f"For show Database update for checkin happened at: {datetime.now()} Successfully!\n")
     # function gets the user that are not verified and deletes them from the table if they are not verified after 5 days
-    delete_not_verified_users(next(get_database()))
+    purge_unverified_users()
     with open("delete_users.log", "a") as f:
         f.write(f"For show Not Verified Users Deleted at: {datetime.now()} Successfully!\n")
 
 
+# moves the responses of old check-ins and achieved goals to the archive
+@sched.scheduled_job('cron', day_of_week='mon-sun', hour=3, minute=0)
+def archive_old_responses():
+    archive_responses()
+
+# removes soft deleted accounts and goals, in small batches
+@sched.scheduled_job('interval', minutes=1)
+def purge_deleted_rows():
+    purger.run_pending()
+
+
 # start the scheduler
 sched.start()
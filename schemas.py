@@ -34,6 +34,29 @@ class Question(QuestionBase):
     class Config:
         orm_mode = True
 
+# a goal as the goal lists return it, without the internal deleted_at
+class GoalSummary(BaseModel):
+    id: int
+    goal_name: str
+    creator_id: int
+    is_paused: bool
+    start_date: date
+    check_in_period: int
+    next_check_in: date
+    check_in_num: int
+    is_public: bool
+    template_id: int
+    is_achieved: bool
+    can_check_in: bool
+    is_group_goal: bool
+    group_id: int | None
+
+    class Config:
+        orm_mode = True
+
+class GoalList(BaseModel):
+    message: list[GoalSummary]
+
 class TemplateBase(BaseModel):
     name: str
     is_custom: bool
@@ -82,6 +105,7 @@ class UserBase(BaseModel):
 class UserCreate(UserBase):
     pw_hash: str
     pw_salt: str
+    pw_cost: int | None = None
 
 class User(UserBase):
     id: int
@@ -94,6 +118,19 @@ class User(UserBase):
     class Config:
         orm_mode = True
 
+# detached, read-only copy of a User handed out by get_current_user
+class UserSnapshot(BaseModel):
+    id: int
+    username: str
+    email: str | None
+    pw_hash: str
+    is_verified: bool
+    token_version: int | None
+
+    class Config:
+        orm_mode = True
+        allow_mutation = False
+
 class FriendBase(BaseModel):
     user1_id: int
     user2_id: int
@@ -0,0 +1,192 @@
+import contextvars
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+import greenlet
+from sqlalchemy import event
+
+# Per-request SQL statistics. instrument_engine() times every statement an engine
+# runs and adds it to the RequestQueryStats of the request running it, which
+# SQLMetricsMiddleware keeps in a context variable (the threadpool and the async
+# driver's greenlets see the same one). At the end of the request the totals are
+# added to the per endpoint counters served by /metrics.
+#   DEBUG=1         also send them back as X-SQL-* response headers
+#   SLOW_QUERY_MS   statements slower than this are logged to "sql.slow" with the
+#                   normalized SQL and the crud function that ran them
+
+DEBUG = os.getenv("DEBUG", "0") == "1"
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 100))
+
+# the innermost frame from one of these is reported as the caller of a statement
+CALLER_MODULES = ("crud", "async_crud", "main")
+
+slow_query_log = logging.getLogger("sql.slow")
+
+_WHITESPACE = re.compile(r"\s+")
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PLACEHOLDERS = re.compile(r"%\(\w+\)s|%s|\$\d+")
+_VALUE_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+
+def normalize_sql(statement: str):
+    """the statement with literals and placeholders as ? and IN lists collapsed"""
+    statement = _WHITESPACE.sub(" ", statement).strip()
+    statement = _LITERALS.sub("?", statement)
+    statement = _PLACEHOLDERS.sub("?", statement)
+    return _VALUE_LISTS.sub("(?)", statement)
+
+
+def calling_function():
+    frame, current = sys._getframe(1), greenlet.getcurrent()
+    while frame is not None:
+        module = frame.f_globals.get("__name__")
+        if module in CALLER_MODULES:
+            return "{module}.{function}".format(module=module, function=frame.f_code.co_name)
+        frame = frame.f_back
+        # async sessions run the statement in a greenlet, the caller waits in its parent
+        if frame is None and current.parent is not None:
+            current = current.parent
+            frame = current.gr_frame
+    return None
+
+
+class RequestQueryStats:
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+        self.slowest_seconds = 0.0
+        self.slowest_caller = None
+
+    def record(self, seconds: float, caller):
+        self.statements += 1
+        self.seconds += seconds
+        if seconds > self.slowest_seconds:
+            self.slowest_seconds = seconds
+            self.slowest_caller = caller
+
+    def headers(self):
+        headers = [(b"x-sql-statements", str(self.statements).encode("latin-1")),
+                   (b"x-sql-time-ms", "{ms:.2f}".format(ms=self.seconds * 1000).encode("latin-1")),
+                   (b"x-sql-slowest-ms", "{ms:.2f}".format(ms=self.slowest_seconds * 1000).encode("latin-1"))]
+        if self.slowest_caller:
+            headers.append((b"x-sql-slowest-caller", self.slowest_caller.encode("latin-1")))
+        return headers
+
+
+current_request_stats = contextvars.ContextVar("current_request_stats", default=None)
+
+
+class SQLMetrics:
+    def __init__(self, slow_query_ms: float = SLOW_QUERY_MS, debug_headers: bool = DEBUG):
+        self.slow_query_ms = slow_query_ms
+        self.debug_headers = debug_headers
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.statements = 0
+            self.seconds = 0.0
+            self.slow_queries = 0
+            # "METHOD /path" -> [requests, statements, seconds, max statements in one request]
+            self._endpoints = {}
+
+    def record_statement(self, statement: str, seconds: float):
+        stats = current_request_stats.get()
+        slow = seconds * 1000 >= self.slow_query_ms
+        # walking the stack is only worth it for statements someone will look at
+        caller = calling_function() if slow or (stats is not None and seconds > stats.slowest_seconds) else None
+        if stats is not None:
+            stats.record(seconds, caller)
+        with self._lock:
+            self.statements += 1
+            self.seconds += seconds
+            if slow:
+                self.slow_queries += 1
+        if slow:
+            slow_query_log.warning("slow query %.1f ms in %s: %s", seconds * 1000, caller or "?",
+                                   normalize_sql(statement))
+
+    def record_request(self, endpoint: str, stats: RequestQueryStats):
+        with self._lock:
+            entry = self._endpoints.setdefault(endpoint, [0, 0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += stats.statements
+            entry[2] += stats.seconds
+            entry[3] = max(entry[3], stats.statements)
+
+    def stats(self):
+        with self._lock:
+            return {"statements": self.statements,
+                    "db_time_ms": round(self.seconds * 1000, 3),
+                    "slow_queries": self.slow_queries,
+                    "slow_query_ms": self.slow_query_ms,
+                    "endpoints": {endpoint: {"requests": requests,
+                                             "mean_statements": round(statements / requests, 2),
+                                             "max_statements": max_statements,
+                                             "mean_db_time_ms": round(seconds / requests * 1000, 3)}
+                                  for endpoint, (requests, statements, seconds, max_statements)
+                                  in sorted(self._endpoints.items())}}
+
+
+sql_metrics = SQLMetrics()
+
+
+def instrument_engine(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("statement_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["statement_started"].pop()
+        sql_metrics.record_statement(statement, time.perf_counter() - started)
+
+    @event.listens_for(engine, "handle_error")
+    def drop_statement_timer(exception_context):
+        started = exception_context.connection.info.get("statement_started") \
+            if exception_context.connection is not None else None
+        if started:
+            started.pop()
+
+
+class SQLMetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+        # endpoint function -> "METHOD /path", filled from the app's routes
+        self._endpoint_names = {}
+
+    def endpoint_name(self, scope):
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        name = self._endpoint_names.get((endpoint, scope["method"]))
+        if name is None:
+            path = next((route.path for route in scope["app"].routes
+                         if getattr(route, "endpoint", None) is endpoint), scope["path"])
+            name = "{method} {path}".format(method=scope["method"], path=path)
+            self._endpoint_names[(endpoint, scope["method"])] = name
+        return name
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestQueryStats()
+        token = current_request_stats.set(stats)
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                message = dict(message, headers=list(message.get("headers", [])) + stats.headers())
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_headers if sql_metrics.debug_headers else send)
+        finally:
+            current_request_stats.reset(token)
+            sql_metrics.record_request(self.endpoint_name(scope), stats)
@@ -1,5 +1,6 @@
 from functools import wraps
 from time import perf_counter
+import inspect
 import re
 
 # Make a regular expression
@@ -9,6 +10,23 @@ regex = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
 
 def measure_time(func):
     """decorator to measure time for function execution"""
+    if inspect.iscoroutinefunction(func):
+        # keep async handlers async, FastAPI would otherwise run them in the threadpool
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+
+            start_time = perf_counter()
+
+            result = await func(*args, **kwargs)
+
+            delta = round(perf_counter() - start_time, 5)
+
+            print(f"\033[48;5;4m{func.__name__} : {delta*1000} ms\033[0m")
+
+            return result
+
+        return async_wrapper
+
     @wraps(func)
     def wrapper(*args, **kwargs):
 
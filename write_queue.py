@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from contextlib import suppress
+
+from database import SessionLocal, read_your_writes
+
+# Group commit for bursts of small writes on SQLite, where every transaction
+# takes the database's single write lock and (outside WAL) an fsync of its own.
+# With WRITE_QUEUE=1 the handlers hand their writes to write_coordinator (see
+# main.write) instead of committing them in the request's transaction. One writer
+# thread takes what is queued, waits up to WRITE_QUEUE_WINDOW_MS for more, and
+# runs up to WRITE_QUEUE_MAX_BATCH operations in one transaction, each in a
+# savepoint so a failing one only fails its own caller. The callers' futures are
+# resolved once the transaction is committed, or failed with whatever went wrong;
+# a caller waits at most WRITE_QUEUE_TIMEOUT_SECONDS and answers 503 after that.
+#   WRITE_QUEUE            1 to send the handlers' writes through the writer thread
+#   WRITE_QUEUE_WINDOW_MS  how long a batch waits for more operations; with 0 a
+#                          batch is what queued up while the last one committed,
+#                          a lone writer is not held back (python benchmarks.py writes)
+#   WRITE_QUEUE_MAX_BATCH  operations committed together at most
+#   WRITE_QUEUE_TIMEOUT_SECONDS  how long a caller waits for its write
+
+WRITE_QUEUE = os.getenv("WRITE_QUEUE", "0") == "1"
+WRITE_QUEUE_WINDOW_MS = float(os.getenv("WRITE_QUEUE_WINDOW_MS", 0))
+WRITE_QUEUE_MAX_BATCH = int(os.getenv("WRITE_QUEUE_MAX_BATCH", 64))
+WRITE_QUEUE_TIMEOUT_SECONDS = float(os.getenv("WRITE_QUEUE_TIMEOUT_SECONDS", 10))
+
+write_log = logging.getLogger("write_queue")
+
+# put on the queue by stop()
+_STOP = object()
+
+
+class WriteCoordinator:
+    def __init__(self, session_factory=SessionLocal, enabled: bool = WRITE_QUEUE,
+                 window_ms: float = WRITE_QUEUE_WINDOW_MS, max_batch: int = WRITE_QUEUE_MAX_BATCH,
+                 timeout_seconds: float = WRITE_QUEUE_TIMEOUT_SECONDS):
+        self.session_factory = session_factory
+        self.enabled = enabled
+        self.window_seconds = window_ms / 1000
+        self.max_batch = max_batch
+        self.timeout_seconds = timeout_seconds
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.reset()
+
+    def submit(self, operation, sticky_key=None):
+        """runs operation(db) in the writer's next transaction; a Future of what it returned
+
+        The session is closed by the time the Future is resolved, so operations
+        return plain values (ids), not the rows they wrote.
+        """
+        future = Future()
+        self._start()
+        self._queue.put((operation, future, sticky_key))
+        return future
+
+    async def run(self, operation, sticky_key=None):
+        return await asyncio.wrap_future(self.submit(operation, sticky_key))
+
+    def _start(self):
+        with self._lock:
+            # started on first use, and again should the writer have died
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._write_batches, name="write-queue", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join()
+
+    def _next_batch(self):
+        item = self._queue.get()
+        if item is _STOP:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.window_seconds
+        while len(batch) < self.max_batch:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is _STOP:
+                # finish this batch first
+                self._queue.put(_STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def _write_batches(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self.write_batch(batch)
+
+    def write_batch(self, batch):
+        # whatever fails, no caller is left waiting
+        try:
+            failed = self._write_batch(batch)
+        except Exception as e:
+            write_log.exception("write batch of %d failed", len(batch))
+            failed = 0
+            for _, future, _ in batch:
+                if not future.done():
+                    failed += 1
+                    # a caller that gave up may cancel a future not yet started
+                    with suppress(InvalidStateError):
+                        future.set_exception(e)
+        self._record(len(batch), failed)
+
+    def _write_batch(self, batch):
+        written = []
+        failed = 0
+        db = self.session_factory()
+        try:
+            for operation, future, sticky_key in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    with db.begin_nested():
+                        result = operation(db)
+                except Exception as e:
+                    failed += 1
+                    future.set_exception(e)
+                    continue
+                written.append((future, result, sticky_key))
+            db.commit()
+        finally:
+            db.close()
+        for future, result, sticky_key in written:
+            read_your_writes.mark(sticky_key)
+            future.set_result(result)
+        return failed
+
+    def _record(self, operations: int, failed: int):
+        with self._lock:
+            self.batches += 1
+            self.operations += operations
+            self.failed += failed
+            self.largest_batch = max(self.largest_batch, operations)
+
+    def reset(self):
+        with self._lock:
+            self.batches = 0
+            self.operations = 0
+            self.failed = 0
+            self.largest_batch = 0
+
+    def stats(self):
+        with self._lock:
+            return {"enabled": self.enabled,
+                    "queued": self._queue.qsize(),
+                    "batches": self.batches,
+                    "operations": self.operations,
+                    "failed": self.failed,
+                    "mean_batch": round(self.operations / self.batches, 2) if self.batches else 0.0,
+                    "largest_batch": self.largest_batch}
+
+
+write_coordinator = WriteCoordinator()